@@ -1,19 +1,65 @@
 import os
+import io
+import csv
 import json
 import re
+import sys
+import glob
+import gzip
+import hmac
+import hashlib
+import base64
+import urllib.parse
+import importlib.util
+import time
+import bisect
+import signal
+import struct
+import zlib
+import asyncio
+import cProfile
+import pstats
+import sqlite3
+import tempfile
+import tracemalloc
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from pathlib import Path
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+import html
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from array import array
+from collections import deque, OrderedDict
 from telegram import (
+    __version__ as PTB_VERSION,
+    Bot,
     Update,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
 )
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
+    BaseHandler,
+    BasePersistence,
+    BaseUpdateProcessor,
+    PersistenceInput,
     CommandHandler,
+    InlineQueryHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
     ConversationHandler,
 )
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.request import BaseRequest, HTTPXRequest
 
 # =============================
 #        НАСТРОЙКИ
@@ -28,6 +74,100 @@ ADMIN_IDS = {455103834, 420322968, 276249332, 338466748, 273240174}
 # Файл хранения данных
 DATA_FILE = "party_data.json"
 
+# Как часто обновлять «живые» таблицы (сек) и сколько правок в секунду делать максимум
+LIVE_BOARD_INTERVAL = int(os.getenv("LIVE_BOARD_INTERVAL", "15"))
+LIVE_EDITS_PER_SEC = float(os.getenv("LIVE_EDITS_PER_SEC", "20"))
+
+# Сколько секунд Telegram кэширует ответы на инлайн-запрос «@бот top»
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "30"))
+
+# Через сколько секунд простоя диалог завершается, а промежуточное состояние
+# пользователя выгружается (0 — никогда), и как часто запускать очистку
+SESSION_TTL = int(os.getenv("SESSION_TTL", "1800"))
+SESSION_SWEEP_INTERVAL = int(os.getenv("SESSION_SWEEP_INTERVAL", "300"))
+
+# Как часто (сек) сохранять состояния диалогов и курсоры игр, чтобы рестарт их не терял
+PERSIST_INTERVAL = int(os.getenv("PERSIST_INTERVAL", "30"))
+
+# HTTP-пулы к Bot API: обычные ответы, загрузка картинок и long-poll getUpdates
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))
+HTTP_MEDIA_POOL_SIZE = int(os.getenv("HTTP_MEDIA_POOL_SIZE", "8"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))
+HTTP_MEDIA_TIMEOUT = float(os.getenv("HTTP_MEDIA_TIMEOUT", "30"))
+HTTP_POLL_TIMEOUT = float(os.getenv("HTTP_POLL_TIMEOUT", "30"))
+HTTP2 = os.getenv("HTTP2", "0") == "1"
+
+# Свой сервер telegram-bot-api (пусто — публичный api.telegram.org).
+# BOT_API_LOCAL_MODE=1 — сервер на той же машине: картинки отдаём ему путём к файлу,
+# без загрузки через multipart
+BOT_API_URL = os.getenv("BOT_API_URL", "").rstrip("/")
+BOT_API_LOCAL_MODE = os.getenv("BOT_API_LOCAL_MODE", "0") == "1"
+
+# Дополнительные боты с теми же игроками и баллами, чтобы разнести гостей по разным
+# лимитам отправки: «метка=токен,метка=токен». Основной бот — TELEGRAM_BOT_TOKEN
+EXTRA_BOT_TOKENS = os.getenv("EXTRA_BOT_TOKENS", "")
+
+# Несколько вечеринок в одном процессе: каталог событий (пусто — одно событие, как раньше).
+# Событие — подкаталог с event.json (админы, вопросы) и своим party_data.json.
+# Гость попадает в событие по ссылке t.me/бот?start=ev-<имя>, ev-main — обратно в основное.
+# Данные события загружаются при первом обращении и выгружаются после EVENT_IDLE_TTL сек простоя
+EVENTS_DIR = os.getenv("EVENTS_DIR", "")
+EVENT_IDLE_TTL = int(os.getenv("EVENT_IDLE_TTL", "3600"))
+
+# Режим воркеров за вебхуком: сколько процессов (1 — обычный long polling),
+# общий файл состояния и адрес, на который Telegram присылает апдейты.
+# WEBHOOK_SECRET сверяется с заголовком X-Telegram-Bot-Api-Secret-Token
+WORKERS = int(os.getenv("WORKERS", "1"))
+STORE_DB = os.getenv("STORE_DB", "party_data.sqlite")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+# Резервные копии: каталог ("" — рядом с DATA_FILE), период в секундах (0 — выключено)
+# и сколько часов хранить почасовые копии; за последний час хранятся все
+BACKUP_DIR = os.getenv("BACKUP_DIR", "")
+BACKUP_INTERVAL = int(os.getenv("BACKUP_INTERVAL", "60"))
+BACKUP_KEEP_HOURS = int(os.getenv("BACKUP_KEEP_HOURS", "48"))
+
+# Табло для большого экрана: локальный HTTP-порт (0 — выключено)
+SCOREBOARD_HOST = os.getenv("SCOREBOARD_HOST", "127.0.0.1")
+SCOREBOARD_PORT = int(os.getenv("SCOREBOARD_PORT", "0"))
+
+# QR-коды офлайн-квеста: сколько их, сколько баллов за каждый и секрет для подписи ссылок
+QR_CODES_COUNT = int(os.getenv("QR_CODES_COUNT", "6"))
+QR_POINTS = int(os.getenv("QR_POINTS", "1"))
+QR_SECRET = os.getenv("QR_SECRET") or TOKEN
+
+# Профилирование по команде /profile: верхний предел длительности, сек
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "300"))
+
+# Запись входящих апдейтов для реплея (пусто — запись выключена)
+RECORD_FILE = os.getenv("RECORD_UPDATES_FILE", "")
+# Секретная соль для хеширования персональных данных в записи — обязательна при записи,
+# для реплея нужна та же. Значения по умолчанию нет: Telegram ID перебираются быстро,
+# и с известной солью псевдо-ID обращаются обратно
+RECORD_SALT = os.getenv("RECORD_SALT", "")
+RECORD_SALT_MIN_LENGTH = 16
+
+# Разбор накопившихся апдейтов после рестарта
+TRIAGE_BACKLOG = os.getenv("TRIAGE_BACKLOG", "1") == "1"
+# Запросы «только посмотреть» старше этого возраста (сек) выбрасываются
+TRIAGE_MAX_AGE = int(os.getenv("TRIAGE_MAX_AGE", "60"))
+
+# Приоритетная обработка апдейтов: сколько апдейтов обрабатывается одновременно
+# (1 — строго по очереди, как раньше), веса и лимиты по классам
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "16"))
+SCHED_WEIGHTS = os.getenv("SCHED_WEIGHTS", "admin:6,game:3,view:1")
+SCHED_LIMITS = os.getenv("SCHED_LIMITS", "admin:8,game:12,view:4")
+
+# Фильтр частых нажатий: окно для повторов одного и того же текста (сек),
+# лимит запросов пользователя в секунду, запас «пачки» и сколько пользователей помнить
+DUP_WINDOW = float(os.getenv("DUP_WINDOW", "1.5"))
+USER_RATE = float(os.getenv("USER_RATE", "2"))
+USER_BURST = int(os.getenv("USER_BURST", "5"))
+ADMISSION_MAX_USERS = int(os.getenv("ADMISSION_MAX_USERS", "5000"))
+
 # =============================
 #      ГЛОБАЛЬНОЕ СОСТОЯНИЕ
 # =============================
@@ -52,33 +192,334 @@ tg_to_user = {}
 
 next_uid = 1
 
+# Растёт при любом изменении баллов или состава игроков —
+# по нему видно, что таблицы пора пересчитать
+scores_version = 0
+
+# team_stats: {"red"|"blue": {"total": int, "count": int, "top_uid": uid|None}}
+# Считается по офлайн-игрокам с браслетом, обновляется на каждом изменении за O(1).
+# top_uid = None — лидер неизвестен (лидер потерял баллы), пересчитается при чтении.
+team_stats = {
+    "red": {"total": 0, "count": 0, "top_uid": None},
+    "blue": {"total": 0, "count": 0, "top_uid": None},
+}
+
+# Индексы предрегистрации (гости из загруженного списка, ещё не нажавшие «Регистрация»):
+# prereg_by_username: {username в нижнем регистре: uid}
+# prereg_by_name: {нормализованное имя: [uid, ...]}
+prereg_by_username = {}
+prereg_by_name = {}
+
+# qr_redeemed: {(uid, номер QR-кода)} — кто какой код уже отсканировал
+qr_redeemed = set()
+
+# sessions: {"conv": {"chat_id:user_id": состояние}, "user": {tg_id: {ключ: значение}},
+#            "bots": {метка: {"conv": ..., "user": ...}}}
+# Состояния диалогов и курсоры игр для StorePersistence — переживают рестарт.
+# У дополнительных ботов диалоги свои — они лежат в "bots" под меткой бота.
+sessions = {"conv": {}, "user": {}}
+
+# live_boards: {mode: {chat_id: message_id}} — «живые» таблицы, которые бот редактирует.
+# Таблицы дополнительных ботов — под ключом "mode@метка": править сообщение может только его автор
+live_boards = {"online": {}, "offline": {}}
+
+# {метка: Application} — все боты этого процесса, для сводки в /stats
+bot_apps = {}
+
+# Имя события, которое обслуживает этот экземпляр модуля ("" — основное, см. EventPartition)
+EVENT_SLUG = ""
+
+# В режиме воркеров — общее хранилище SharedStore и номер этого процесса.
+# store = None — обычный режим: всё в памяти и в снимке рядом с DATA_FILE
+store = None
+worker_index = 0
+
 # =============================
 #     ЗАГРУЗКА / СОХРАНЕНИЕ
 # =============================
 
+# Снимок состояния — бинарный файл рядом с DATA_FILE (party_data.snap):
+#   заголовок: сигнатура, версия, длина и crc32 всего остального;
+#   дальше секции с длиной впереди — столбцы по игрокам (uid, баллы, режим,
+#   команда, флаги игр, имена), пары tg_id → uid и JSON со всем прочим
+#   (редкие поля игроков, чаты, диалоги, QR-коды).
+# Предыдущий снимок остаётся в .prev — на него откатываемся, если текущий битый.
+# DATA_FILE в JSON читается только для переноса, если снимков ещё нет.
+SNAPSHOT_MAGIC = b"KTSP"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sHHII")
+SNAPSHOT_SECTION = struct.Struct("<I")
+SNAPSHOT_SECTIONS = 12
+GAME_FLAGS = ("truth_game", "binary_game", "headline_game", "emoji_game")
+USER_COLUMNS = ("name", "points", "mode", "team", "games")
+
+def snapshot_path() -> str:
+    return os.path.splitext(DATA_FILE)[0] + ".snap"
+
+def state_files() -> list:
+    # в порядке предпочтения при загрузке
+    path = snapshot_path()
+    return [path, path + ".prev", DATA_FILE]
+
+def column(typecode: str, values=()) -> array:
+    col = array(typecode, values)
+    if sys.byteorder == "big":
+        col.byteswap()
+    return col
+
+def read_column(typecode: str, buf) -> array:
+    col = array(typecode)
+    col.frombytes(buf)
+    if sys.byteorder == "big":
+        col.byteswap()
+    return col
+
+def encode_snapshot() -> bytes:
+    labels = [None]
+    label_idx = {None: 0}
+    uids, points, modes, teams, flags, name_lens, names, extras = (
+        column("I"), column("q"), column("H"), column("H"), column("B"), column("I"), [], []
+    )
+    for uid, user in users.items():
+        uids.append(uid)
+        points.append(user["points"])
+        for value, col in ((user["mode"], modes), (user["team"], teams)):
+            if value not in label_idx:
+                label_idx[value] = len(labels)
+                labels.append(value)
+            col.append(label_idx[value])
+        games = user["games"]
+        flags.append(sum(1 << i for i, g in enumerate(GAME_FLAGS) if games.get(g)))
+        name = user["name"].encode("utf-8")
+        name_lens.append(len(name))
+        names.append(name)
+        extra = {k: v for k, v in user.items() if k not in USER_COLUMNS}
+        other_games = {g: v for g, v in games.items() if g not in GAME_FLAGS}
+        if other_games:
+            extra["games"] = other_games
+        if extra:
+            extras.append([uid, extra])
+    tg_ids = column("q", tg_to_user.keys())
+    tg_uids = column("I", tg_to_user.values())
+    rest = {
+        "labels": labels[1:],
+        "extras": extras,
+        "live_boards": live_boards,
+        "team_stats": team_stats,
+        "qr_redeemed": sorted(qr_redeemed),
+        "sessions": sessions,
+    }
+    sections = [
+        struct.pack("<II", len(uids), next_uid),
+        uids.tobytes(), points.tobytes(), modes.tobytes(), teams.tobytes(), flags.tobytes(),
+        name_lens.tobytes(), b"".join(names),
+        tg_ids.tobytes(), tg_uids.tobytes(),
+        json.dumps(rest, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+        b"",  # запас под новые столбцы без смены версии
+    ]
+    payload = b"".join(SNAPSHOT_SECTION.pack(len(s)) + s for s in sections)
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, len(payload), zlib.crc32(payload))
+    return header + payload
+
+def snapshot_payload(raw: bytes) -> memoryview:
+    """
+    Проверка заголовка и контрольной суммы; ValueError — файл обрезан,
+    испорчен или другой версии.
+    """
+    if len(raw) < SNAPSHOT_HEADER.size:
+        raise ValueError("файл короче заголовка")
+    magic, version, _, length, crc = SNAPSHOT_HEADER.unpack_from(raw)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError("это не снимок")
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"версия {version}, ожидалась {SNAPSHOT_VERSION}")
+    payload = memoryview(raw)[SNAPSHOT_HEADER.size:]
+    if len(payload) != length or zlib.crc32(payload) != crc:
+        raise ValueError("не сошлась контрольная сумма")
+    return payload
+
+def decode_snapshot(raw: bytes) -> dict:
+    """
+    Снимок -> то же, что лежало в JSON, но uid и tg_id уже int.
+    """
+    payload = snapshot_payload(raw)
+    length = len(payload)
+    sections = []
+    pos = 0
+    while pos < length:
+        (size,) = SNAPSHOT_SECTION.unpack_from(payload, pos)
+        pos += SNAPSHOT_SECTION.size
+        sections.append(payload[pos:pos + size])
+        pos += size
+    if len(sections) < SNAPSHOT_SECTIONS:
+        raise ValueError("не хватает секций")
+
+    count, stored_next_uid = struct.unpack_from("<II", sections[0])
+    uids = read_column("I", sections[1])
+    points = read_column("q", sections[2])
+    modes = read_column("H", sections[3])
+    teams = read_column("H", sections[4])
+    flags = read_column("B", sections[5])
+    name_lens = read_column("I", sections[6])
+    names = bytes(sections[7])
+    tg_ids = read_column("q", sections[8])
+    tg_uids = read_column("I", sections[9])
+    rest = json.loads(bytes(sections[10]).decode("utf-8"))
+    if not all(len(col) == count for col in (uids, points, modes, teams, flags, name_lens)):
+        raise ValueError("столбцы разной длины")
+
+    labels = [None] + rest["labels"]
+    # словарь флагов на каждую комбинацию битов — игроку достаётся копия
+    games_by_bits = [
+        {g: bool(bits >> b & 1) for b, g in enumerate(GAME_FLAGS)} for bits in range(1 << len(GAME_FLAGS))
+    ]
+    loaded = {}
+    pos = 0
+    for i, uid in enumerate(uids):
+        end = pos + name_lens[i]
+        loaded[uid] = {
+            "name": names[pos:end].decode("utf-8"),
+            "points": points[i],
+            "mode": labels[modes[i]],
+            "team": labels[teams[i]],
+            "games": games_by_bits[flags[i]].copy(),
+        }
+        pos = end
+    for uid, extra in rest["extras"]:
+        user = loaded[uid]
+        user["games"].update(extra.pop("games", {}))
+        user.update(extra)
+    return {
+        "users": loaded,
+        "tg_to_user": dict(zip(tg_ids, tg_uids)),
+        "next_uid": stored_next_uid,
+        "live_boards": rest["live_boards"],
+        "team_stats": rest["team_stats"],
+        "qr_redeemed": rest["qr_redeemed"],
+        "sessions": rest["sessions"],
+    }
+
+def decode_state_file(path: str, raw: bytes) -> dict:
+    if path.endswith(".gz"):
+        # резервная копия — сжатый снимок
+        raw = gzip.decompress(raw)
+    if not path.endswith(".json"):
+        return decode_snapshot(raw)
+    data = json.loads(raw.decode("utf-8"))
+    # ключи в JSON — строки, а uid везде используется как int
+    data["users"] = {int(k): v for k, v in data.get("users", {}).items()}
+    data["tg_to_user"] = {int(k): v for k, v in data.get("tg_to_user", {}).items()}
+    return data
+
+def load_local_state(data: dict):
+    """
+    «Живые» таблицы и состояния диалогов — то, что относится к чатам этого процесса.
+    """
+    global sessions
+    for mode, boards in data.get("live_boards", {}).items():
+        live_boards[mode] = {int(chat_id): msg_id for chat_id, msg_id in boards.items()}
+    stored_sessions = data.get("sessions", {})
+    sessions = {
+        "conv": stored_sessions.get("conv", {}),
+        "user": {int(k): v for k, v in stored_sessions.get("user", {}).items()},
+    }
+    for label, part in stored_sessions.get("bots", {}).items():
+        sessions.setdefault("bots", {})[label] = {
+            "conv": part.get("conv", {}),
+            "user": {int(k): v for k, v in part.get("user", {}).items()},
+        }
+
 def load_data():
-    global users, tg_to_user, next_uid
-    if not os.path.exists(DATA_FILE):
+    global users, tg_to_user, next_uid, qr_redeemed
+    load_question_stats()
+    compile_answer_matchers()
+    if store is not None:
+        # воркер: игроки и баллы — в общем хранилище, своё — только чаты этого процесса
+        load_local_state(store.worker_state())
+        qr_redeemed = store.qr_codes()
+        recount_teams()
+        store.pull()
         return
-    try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        users = data.get("users", {})
-        tg_to_user = {int(k): v for k, v in data.get("tg_to_user", {}).items()}
-        next_uid = data.get("next_uid", 1)
-    except:
+    data = None
+    read_ms = decode_ms = 0.0
+    snapshots = state_files()
+    # оба снимка битые — дальше свежие резервные копии, и только потом JSON:
+    # он нужен для переноса и после первого снимка устаревает
+    folder = backup_dir()
+    candidates = snapshots[:2] + [
+        os.path.join(folder, name) for _, name in list_backups(folder) if name.endswith(".snap.gz")
+    ] + snapshots[2:]
+    tried = []
+    for path in candidates:
+        if not os.path.exists(path):
+            continue
+        tried.append(path)
+        started = time.perf_counter()
+        try:
+            with open(path, "rb") as f:
+                raw = f.read()
+            read_ms = (time.perf_counter() - started) * 1000
+            data = decode_state_file(path, raw)
+        except (OSError, EOFError, ValueError, struct.error, zlib.error) as e:
+            print(f"Не удалось прочитать {path}: {e}")
+            continue
+        decode_ms = (time.perf_counter() - started) * 1000 - read_ms
+        if path == DATA_FILE and len(tried) == 1:
+            print(f"Данные из {path} перенесены, дальше сохраняются в {snapshot_path()}")
+        elif path != snapshots[0]:
+            print(f"Состояние восстановлено из {path}")
+        break
+
+    if data is None and tried:
+        # пустое состояние при следующем save_data затёрло бы и то, что ещё можно спасти
+        raise RuntimeError(
+            "Не удалось прочитать ни один файл состояния: " + ", ".join(tried)
+            + ". Бот не запущен, чтобы не затереть их пустыми данными."
+        )
+    if data is None:
         users = {}
         tg_to_user = {}
         next_uid = 1
+        stored_teams = {}
+    else:
+        users = data["users"]
+        tg_to_user = data["tg_to_user"]
+        next_uid = data.get("next_uid", 1)
+        load_local_state(data)
+        stored_teams = data.get("team_stats", {})
+        qr_redeemed = {(uid, code) for uid, code in data.get("qr_redeemed", [])}
+
+    indexed = time.perf_counter()
+    recount_teams()
+    rebuild_prereg_index()
+    if data is not None:
+        print(
+            f"Загрузка: игроков {len(users)}, чтение {read_ms:.1f} мс, "
+            f"разбор {decode_ms:.1f} мс, индексы {(time.perf_counter() - indexed) * 1000:.1f} мс"
+        )
+    for team, stats in team_stats.items():
+        stored = stored_teams.get(team)
+        if stored and (stored.get("total"), stored.get("count")) != (stats["total"], stats["count"]):
+            print(
+                f"Счёт команды {team} расходился с пересчётом: "
+                f"было {stored.get('total')}/{stored.get('count')}, "
+                f"стало {stats['total']}/{stats['count']}"
+            )
 
 def save_data():
-    data = {
-        "users": users,
-        "tg_to_user": tg_to_user,
-        "next_uid": next_uid,
-    }
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    if store is not None:
+        store.push()
+        return
+    blob = encode_snapshot()
+    # пишем во временный файл и подменяем — недописанный файл не затрёт старый,
+    # а прошлый снимок остаётся в .prev на случай, если испортится и этот
+    path = snapshot_path()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(blob)
+    if os.path.exists(path):
+        os.replace(path, path + ".prev")
+    os.replace(tmp_path, path)
 
 # =============================
 #   СОСТОЯНИЯ ДЛЯ МЕНЮ/ИГР
@@ -109,6 +550,18 @@ def start_keyboard():
         resize_keyboard=True
     )
 
+LEADERBOARD_BUTTONS = {"🏆 Турнирная таблица", "Турнирная таблица"}
+POINTS_BUTTONS = {"🧮 Мои баллы", "Мои баллы"}
+
+# Кнопки, которые только показывают данные и ничего не меняют
+READ_ONLY_BUTTONS = LEADERBOARD_BUTTONS | POINTS_BUTTONS | {
+    "👁 Играть", "Играть",
+    "ℹ️ Правила игры",
+    "⚔️ Счёт команд",
+    "Список участников",
+    "Топ-5 игроков в каждой команде",
+}
+
 def is_admin_id(tg_id: int) -> bool:
     return tg_id in ADMIN_IDS
 
@@ -129,6 +582,7 @@ def offline_menu_for(tg_id: int):
         buttons = [
             ["👁 Играть"],
             ["🧮 Мои баллы", "🏆 Турнирная таблица"],
+            ["⚔️ Счёт команд"],
             ["➕ Добавить баллы", "Список участников"],
             ["Топ-5 игроков в каждой команде"],
             ["ℹ️ Правила игры"],
@@ -137,6 +591,7 @@ def offline_menu_for(tg_id: int):
         buttons = [
             ["👁 Играть"],
             ["🧮 Мои баллы", "🏆 Турнирная таблица"],
+            ["⚔️ Счёт команд"],
             ["ℹ️ Правила игры"],
         ]
     return ReplyKeyboardMarkup(buttons, resize_keyboard=True)
@@ -215,6 +670,20 @@ def require_registered(func):
         return await func(update, context)
     return wrapper
 
+def make_user(name: str, mode: str, team=None) -> dict:
+    return {
+        "name": name,
+        "points": 0,
+        "mode": mode,
+        "team": team,  # браслет/команда для офлайн
+        "games": {
+            "truth_game": False,
+            "binary_game": False,
+            "headline_game": False,
+            "emoji_game": False
+        }
+    }
+
 def get_user_by_tg(update: Update):
     tg_id = update.effective_user.id
     if tg_id not in tg_to_user:
@@ -222,11 +691,121 @@ def get_user_by_tg(update: Update):
     uid = tg_to_user[tg_id]
     return users.get(uid), uid
 
+async def send_game_photo(update: Update, img: str, caption: str, reply_markup):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), img)
+    if BOT_API_LOCAL_MODE:
+        # в local mode PTB превращает Path в file://-ссылку, файл читает сам сервер
+        await update.message.reply_photo(Path(path), caption=caption, reply_markup=reply_markup)
+        return
+    with open(path, "rb") as ph:
+        await update.message.reply_photo(ph, caption=caption, reply_markup=reply_markup)
+
+def mark_scores_changed():
+    global scores_version
+    scores_version += 1
+
+def team_of(user: dict):
+    # гость из списка, ещё не пришедший в бота, за команду пока не играет
+    if user.get("prereg"):
+        return None
+    if user.get("mode") == "offline" and user.get("team") in ("red", "blue"):
+        return user["team"]
+    return None
+
+def recount_teams():
+    """
+    Полный пересчёт счёта команд — при загрузке.
+    """
+    global team_stats
+    team_stats = {team: {"total": 0, "count": 0, "top_uid": None} for team in ("red", "blue")}
+    for uid in users:
+        team_attach(uid)
+
+def team_attach(uid):
+    user = users[uid]
+    team = team_of(user)
+    if not team:
+        return
+    stats = team_stats[team]
+    pts = user.get("points", 0)
+    stats["total"] += pts
+    stats["count"] += 1
+    top_uid = stats["top_uid"]
+    if stats["count"] == 1 or (top_uid is not None and pts > users[top_uid].get("points", 0)):
+        stats["top_uid"] = uid
+
+def team_detach(uid):
+    """
+    Убирает игрока из счёта команды — перед сменой браслета или режима.
+    """
+    user = users[uid]
+    team = team_of(user)
+    if not team:
+        return
+    stats = team_stats[team]
+    stats["total"] -= user.get("points", 0)
+    stats["count"] -= 1
+    if stats["top_uid"] == uid:
+        stats["top_uid"] = None
+
+def team_top_player(team: str):
+    stats = team_stats[team]
+    if stats["top_uid"] is None and stats["count"]:
+        stats["top_uid"] = team_entries(team)[0][0]
+    return stats["top_uid"]
+
+def allocate_uids(count: int = 1) -> int:
+    """
+    Выдаёт count идущих подряд ID и возвращает первый.
+    """
+    global next_uid
+    if store is not None:
+        return store.allocate_uids(count)
+    uid = next_uid
+    next_uid += count
+    return uid
+
+def add_points(uid, delta: int, source: str = "game", actor: int = None, undo_of: int = None) -> int:
+    """
+    Единственное место, где меняются баллы. Возвращает новое значение.
+    Каждое изменение пишется в журнал: кто (actor — tg_id), кому, сколько и откуда
+    (source: "game", "admin", "qr" или "undo" — отмена записи undo_of).
+    """
+    user = users[uid]
+    # гарантируем, что points — число
+    try:
+        old_points = int(user.get("points", 0))
+    except (TypeError, ValueError):
+        old_points = 0
+    entry = (actor, uid, delta, source, undo_of)
+    if store is not None:
+        # у воркеров баллы меняются атомарно в общей базе — вместе с чужими начислениями,
+        # запись в журнал — в той же транзакции
+        new_points = store.add_points(uid, delta, entry)
+    else:
+        audit_log().append(*entry)
+        new_points = None
+    user["points"] = old_points + delta if new_points is None else new_points
+
+    team = team_of(user)
+    if team:
+        stats = team_stats[team]
+        stats["total"] += user["points"] - old_points
+        top_uid = stats["top_uid"]
+        if top_uid == uid and user["points"] < old_points:
+            stats["top_uid"] = None
+        elif top_uid is not None and user["points"] > users[top_uid].get("points", 0):
+            stats["top_uid"] = uid
+
+    mark_scores_changed()
+    return user["points"]
+
 # =============================
 #          СТАРТ
 # =============================
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.pop("awaiting_name", None)
     await update.message.reply_text(
         "🤖 Привет! Это бот вечеринки KTS.\n"
         "Для начала выберите, где вы играете:",
@@ -280,18 +859,28 @@ async def choose_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
 #         РЕГИСТРАЦИЯ
 # =============================
 async def registration(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tg = update.effective_user
+    if context.user_data.get("mode") == "offline" and tg.id not in tg_to_user and tg.username:
+        uid = prereg_by_username.get(tg.username.lower())
+        if uid is not None:
+            claim_prereg(uid, tg.id)
+            save_data()
+            return await reply_prereg_done(update, context, uid)
+
     await update.message.reply_text(
         "Введите ваше имя и фамилию:",
         reply_markup=ReplyKeyboardRemove()
     )
+    # следующий текст — имя: UpdateRecorder пишет его хешем
+    context.user_data["awaiting_name"] = True
     return REG_NAME
 
 
 async def save_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global next_uid
-
     name = update.message.text.strip()
+    context.user_data.pop("awaiting_name", None)
     if not validate_name(name):
+        context.user_data["awaiting_name"] = True
         await update.message.reply_text(
             "Имя должно содержать минимум 2 слова и только буквы.\n"
             "Например: «Иван Петров»."
@@ -310,6 +899,8 @@ async def save_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # обновляем / создаём пользователя
     if tg_id in tg_to_user:
         uid = tg_to_user[tg_id]
+        if uid in users:
+            team_detach(uid)
         user = users.get(uid, {})
         user["name"] = name
         user["mode"] = mode
@@ -317,23 +908,21 @@ async def save_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if "team" not in user:
             user["team"] = None
         users[uid] = user
+        team_attach(uid)
     else:
-        uid = next_uid
-        next_uid += 1
-        users[uid] = {
-            "name": name,
-            "points": 0,
-            "mode": mode,
-            "team": None,  # браслет/команда для офлайн
-            "games": {
-                "truth_game": False,
-                "binary_game": False,
-                "headline_game": False,
-                "emoji_game": False
-            }
-        }
+        # гость из загруженного списка — браслет уже известен, регистрация в один шаг
+        if mode == "offline":
+            uid = find_prereg_by_name(name)
+            if uid is not None:
+                claim_prereg(uid, tg_id)
+                save_data()
+                return await reply_prereg_done(update, context, uid)
+
+        uid = allocate_uids()
+        users[uid] = make_user(name, mode)
         tg_to_user[tg_id] = uid
 
+    mark_scores_changed()
     save_data()
 
     # Если ОНЛАЙН — сразу завершаем регистрацию
@@ -389,6 +978,7 @@ async def save_bracelet(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return MAIN_MENU
 
     # Сохраняем команду
+    team_detach(uid)
     if text == "🔴":
         user["team"] = "red"
         team_text = "красной команде 🔴"
@@ -397,6 +987,8 @@ async def save_bracelet(update: Update, context: ContextTypes.DEFAULT_TYPE):
         team_text = "синей команде 🔵"
 
     users[uid] = user
+    team_attach(uid)
+    mark_scores_changed()
     save_data()
 
     # очищаем промежуточное состояние
@@ -426,23 +1018,61 @@ async def my_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
 #     ТУРНИРНЫЕ ТАБЛИЦЫ
 # =============================
 
-async def build_leaderboard(mode: str):
+# последняя построенная таблица по режимам — отдаём её тем, кого притормозили
+last_leaderboards = {}
+
+# {mode: (scores_version, топ)} — пересчитываем, только если баллы менялись
+top_cache = {}
+
+def top_entries(mode: str, limit: int = 10):
+    cached = top_cache.get(mode)
+    if cached and cached[0] == scores_version:
+        return cached[1][:limit]
+
     data = [
         (uid, info["name"], info["points"])
         for uid, info in users.items()
-        if info["mode"] == mode
+        if info["mode"] == mode and not info.get("prereg")
+    ]
+    data.sort(key=lambda x: x[2], reverse=True)
+    top = data[:max(limit, 10)]
+    top_cache[mode] = (scores_version, top)
+    return top[:limit]
+
+# {team: (scores_version, участники по убыванию баллов)}
+team_cache = {}
+
+def team_entries(team: str):
+    """
+    Офлайн-игроки команды "red"/"blue": [(uid, name, points)] по убыванию баллов.
+    """
+    cached = team_cache.get(team)
+    if cached and cached[0] == scores_version:
+        return cached[1]
+
+    data = [
+        (uid, info["name"], info.get("points", 0))
+        for uid, info in users.items()
+        if info.get("mode") == "offline" and info.get("team") == team and not info.get("prereg")
     ]
     data.sort(key=lambda x: x[2], reverse=True)
+    team_cache[team] = (scores_version, data)
+    return data
 
-    if not data:
+def format_leaderboard(mode: str, top) -> str:
+    if not top:
         return "Пока нет игроков в этом режиме."
 
-    top = data[:10]
     out = [f"Текущий ТОП-10 ({mode}):"]
     for i, (uid, name, pts) in enumerate(top, start=1):
         out.append(f"{i}. {name} — {pts}")
     return "\n".join(out)
 
+async def build_leaderboard(mode: str):
+    text = format_leaderboard(mode, top_entries(mode))
+    last_leaderboards[mode] = text
+    return text
+
 @require_registered
 async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user, uid = get_user_by_tg(update)
@@ -450,6 +1080,25 @@ async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = await build_leaderboard(mode)
     await update.message.reply_text(text)
     return MAIN_MENU
+
+@require_registered
+async def team_score(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    lines = ["Счёт команд:"]
+    for team, title in (("red", "🔴 Красные"), ("blue", "🔵 Синие")):
+        stats = team_stats[team]
+        if not stats["count"]:
+            lines.append(f"{title}: пока нет участников")
+            continue
+        avg = stats["total"] / stats["count"]
+        top_uid = team_top_player(team)
+        top = users[top_uid]
+        lines.append(
+            f"{title}: {stats['total']} баллов, игроков {stats['count']}, "
+            f"в среднем {avg:.1f}\n"
+            f"   лидер — {top['name']} ({top.get('points', 0)})"
+        )
+    await update.message.reply_text("\n".join(lines))
+    return MAIN_MENU
 # =============================
 #      ОНЛАЙН-ИГРА №1
 #       «ГДЕ ПРАВДА?»
@@ -493,6 +1142,7 @@ async def send_truth_question(update: Update, context: ContextTypes.DEFAULT_TYPE
         # игра завершена
         user, uid = get_user_by_tg(update)
         user["games"]["truth_game"] = True
+        context.user_data.pop("game", None)
         save_data()
         await update.message.reply_text(
             "Игра завершена! Баллы были начислены при прохождении.",
@@ -500,18 +1150,19 @@ async def send_truth_question(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return MAIN_MENU
 
+    # какая игра сейчас идёт — чтобы продолжить её после долгого простоя
+    context.user_data["game"] = GAME_TRUTH_Q
+    context.user_data["asked_at"] = time.monotonic()
     img, correct = TRUTH_GAME_QUESTIONS[idx]
-    path = os.path.join(os.path.dirname(__file__), img)
-
-    with open(path, "rb") as ph:
-        await update.message.reply_photo(
-            ph,
-            caption=f"Задание {idx+1}/8\nГде правда?",
-            reply_markup=ReplyKeyboardMarkup(
-                [["Слева", "Справа"], ["🔙 В меню"]],
-                resize_keyboard=True
-            )
+    await send_game_photo(
+        update,
+        img,
+        caption=f"Задание {idx+1}/8\nГде правда?",
+        reply_markup=ReplyKeyboardMarkup(
+            [["Слева", "Справа"], ["🔙 В меню"]],
+            resize_keyboard=True
         )
+    )
     return GAME_TRUTH_Q
 
 @require_registered
@@ -519,6 +1170,7 @@ async def game_truth_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.lower()
 
     if text == "🔙 в меню".lower():
+        context.user_data.pop("game", None)
         await update.message.reply_text("Меню игр:", reply_markup=online_games_menu())
         return MAIN_MENU
 
@@ -533,9 +1185,10 @@ async def game_truth_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # "left" или "right"
     user_choice = "left" if text == "слева" else "right"
+    record_answer("truth", idx, user_choice, user_choice == correct, context)
 
     if user_choice == correct:
-        user["points"] += 1
+        add_points(uid, 1, "game", update.effective_user.id)
         save_data()
         await update.message.reply_text("Верно! +1 балл ✨")
     else:
@@ -544,6 +1197,102 @@ async def game_truth_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["truth_index"] = idx + 1
     return await send_truth_question(update, context)
 
+# =============================
+#   НЕЧЁТКОЕ СРАВНЕНИЕ ОТВЕТОВ
+# =============================
+
+# допустимое число опечаток в зависимости от длины правильного ответа
+FUZZY_TYPOS = ((4, 0), (8, 1))
+FUZZY_TYPOS_MAX = 2
+
+ANSWER_JUNK_RE = re.compile(r"[^\w]+|_")
+
+def fold_answer(text: str) -> str:
+    # регистр, ё/й → е/и, пунктуация и дефисы → пробел
+    t = text.lower().replace("ё", "е").replace("й", "и")
+    return " ".join(ANSWER_JUNK_RE.sub(" ", t).split())
+
+def typos_allowed(answer: str) -> int:
+    for length, typos in FUZZY_TYPOS:
+        if len(answer) <= length:
+            return typos
+    return FUZZY_TYPOS_MAX
+
+def deletions(word: str, depth: int) -> set:
+    # все строки, получаемые из word удалением не более depth символов
+    result = {word}
+    layer = {word}
+    for _ in range(depth):
+        layer = {w[:i] + w[i + 1:] for w in layer for i in range(len(w))}
+        result |= layer
+    return result
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Расстояние Левенштейна; всё, что больше limit, возвращается как limit + 1."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        if min(cur) > limit:
+            return limit + 1
+        prev = cur
+    return min(prev[-1], limit + 1)
+
+class AnswerMatcher:
+    """
+    Правильные варианты одного вопроса, подготовленные заранее: точные формы
+    после fold_answer и индекс удалений (symmetric delete). Две строки
+    на расстоянии ≤ k имеют общую строку среди своих удалений глубины k,
+    поэтому на ответ — один проход по его удалениям и проверка немногих
+    кандидатов, а не сравнение со всеми вариантами.
+    """
+
+    def __init__(self, variants):
+        self.exact = {fold_answer(v) for v in variants}
+        self.exact.discard("")
+        self.depth = max((typos_allowed(v) for v in self.exact), default=0)
+        self.index = {}
+        for v in self.exact:
+            for d in deletions(v, typos_allowed(v)):
+                self.index.setdefault(d, set()).add(v)
+
+    def match(self, text: str) -> bool:
+        answer = fold_answer(text)
+        if answer in self.exact:
+            return True
+        if not self.depth or len(answer) > 64:
+            return False
+        checked = set()
+        for d in deletions(answer, self.depth):
+            for v in self.index.get(d, ()):
+                if v in checked:
+                    continue
+                checked.add(v)
+                if edit_distance(answer, v, typos_allowed(v)) <= typos_allowed(v):
+                    return True
+        return False
+
+# (ответ, варианты...) -> AnswerMatcher; строятся один раз на набор вариантов,
+# так что вопросы событий из event.json получают свои автоматически
+answer_matchers = {}
+
+def answer_matcher(question: tuple) -> AnswerMatcher:
+    """
+    Вопрос — (картинка или эмодзи, ответ[, [другие варианты]]).
+    """
+    variants = (question[1],) + tuple(question[2] if len(question) > 2 else ())
+    matcher = answer_matchers.get(variants)
+    if matcher is None:
+        matcher = answer_matchers[variants] = AnswerMatcher(variants)
+    return matcher
+
+def compile_answer_matchers():
+    for question in BINARY_GAME_QUESTIONS + EMOJI_GAME_QUESTIONS:
+        answer_matcher(question)
+
 # =============================
 #      ОНЛАЙН-ИГРА №2
 #   «РАСШИФРУЙ БИНАРНЫЙ КОД»
@@ -580,6 +1329,7 @@ async def send_binary_question(update: Update, context: ContextTypes.DEFAULT_TYP
     if idx >= len(BINARY_GAME_QUESTIONS):
         user, uid = get_user_by_tg(update)
         user["games"]["binary_game"] = True
+        context.user_data.pop("game", None)
         save_data()
         await update.message.reply_text(
             "Игра завершена!",
@@ -587,18 +1337,18 @@ async def send_binary_question(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         return MAIN_MENU
 
-    img, ans = BINARY_GAME_QUESTIONS[idx]
-    path = os.path.join(os.path.dirname(__file__), img)
-
-    with open(path, "rb") as ph:
-        await update.message.reply_photo(
-            ph,
-            caption=f"Задание {idx+1}/5\nВведите ответ текстом:",
-            reply_markup=ReplyKeyboardMarkup(
-                [["🔙 В меню"]],
-                resize_keyboard=True
-            )
+    context.user_data["game"] = GAME_BINARY_Q
+    context.user_data["asked_at"] = time.monotonic()
+    img = BINARY_GAME_QUESTIONS[idx][0]
+    await send_game_photo(
+        update,
+        img,
+        caption=f"Задание {idx+1}/5\nВведите ответ текстом:",
+        reply_markup=ReplyKeyboardMarkup(
+            [["🔙 В меню"]],
+            resize_keyboard=True
         )
+    )
 
     return GAME_BINARY_Q
 
@@ -607,16 +1357,20 @@ async def game_binary_answer(update: Update, context: ContextTypes.DEFAULT_TYPE)
     text = update.message.text.strip().lower()
 
     if text == "🔙 в меню".lower():
+        context.user_data.pop("game", None)
         await update.message.reply_text("Меню игр:", reply_markup=online_games_menu())
         return MAIN_MENU
 
     idx = context.user_data.get("binary_index", 0)
-    img, ans = BINARY_GAME_QUESTIONS[idx]
+    question = BINARY_GAME_QUESTIONS[idx]
+    ans = question[1]
 
     user, uid = get_user_by_tg(update)
+    correct = answer_matcher(question).match(text)
+    record_answer("binary", idx, fold_answer(text), correct, context)
 
-    if text == ans.lower():
-        user["points"] += 1
+    if correct:
+        add_points(uid, 1, "game", update.effective_user.id)
         save_data()
         await update.message.reply_text(f"Верно! «{ans}» +1 балл ✨")
     else:
@@ -685,6 +1439,7 @@ async def send_headline_question(update: Update, context: ContextTypes.DEFAULT_T
     if idx >= len(HEADLINE_GAME_QUESTIONS):
         user, uid = get_user_by_tg(update)
         user["games"]["headline_game"] = True
+        context.user_data.pop("game", None)
         save_data()
         await update.message.reply_text(
             "Игра завершена!",
@@ -692,18 +1447,18 @@ async def send_headline_question(update: Update, context: ContextTypes.DEFAULT_T
         )
         return MAIN_MENU
 
+    context.user_data["game"] = GAME_HEADLINE_Q
+    context.user_data["asked_at"] = time.monotonic()
     img, is_true = HEADLINE_GAME_QUESTIONS[idx]
-    path = os.path.join(os.path.dirname(__file__), img)
-
-    with open(path, "rb") as ph:
-        await update.message.reply_photo(
-            ph,
-            caption=f"Задание {idx+1}/8\nПравда или ложь?",
-            reply_markup=ReplyKeyboardMarkup(
-                [["Правда", "Ложь"], ["🔙 В меню"]],
-                resize_keyboard=True
-            )
+    await send_game_photo(
+        update,
+        img,
+        caption=f"Задание {idx+1}/8\nПравда или ложь?",
+        reply_markup=ReplyKeyboardMarkup(
+            [["Правда", "Ложь"], ["🔙 В меню"]],
+            resize_keyboard=True
         )
+    )
     return GAME_HEADLINE_Q
 
 @require_registered
@@ -711,6 +1466,7 @@ async def game_headline_answer(update: Update, context: ContextTypes.DEFAULT_TYP
     text = update.message.text.strip().lower()
 
     if text == "🔙 в меню".lower():
+        context.user_data.pop("game", None)
         await update.message.reply_text("Меню игр:", reply_markup=online_games_menu())
         return MAIN_MENU
 
@@ -723,8 +1479,9 @@ async def game_headline_answer(update: Update, context: ContextTypes.DEFAULT_TYP
     user, uid = get_user_by_tg(update)
 
     user_choice = (text == "правда")
+    record_answer("headline", idx, text, user_choice == is_true, context)
     if user_choice == is_true:
-        user["points"] += 1
+        add_points(uid, 1, "game", update.effective_user.id)
         save_data()
         await update.message.reply_text("Верно! +1 балл ✨")
     else:
@@ -738,10 +1495,12 @@ async def game_headline_answer(update: Update, context: ContextTypes.DEFAULT_TYP
 #   «УГАДАЙ МЕЛОДИЮ ПО ЭМОДЗИ»
 # =============================
 
+# (эмодзи, ответ[, [другие варианты]]) — регистр, ё, дефисы и пара опечаток
+# прощаются и так, см. AnswerMatcher
 EMOJI_GAME_QUESTIONS = [
-    ("💯 🏃‍➡️⬅️", "сто шагов назад"),
+    ("💯 🏃‍➡️⬅️", "сто шагов назад", ["100 шагов назад"]),
     ("☔️🔫", "дожди пистолеты"),
-    ("👐🌞", "солнышко в руках"),
+    ("👐🌞", "солнышко в руках", ["солнышко"]),
     ("🍫🐰", "шоколадный заяц"),
     ("⚪️🌃⬇️☁️", "белая ночь"),
 ]
@@ -779,6 +1538,7 @@ async def send_emoji_question(update: Update, context: ContextTypes.DEFAULT_TYPE
     if idx >= len(EMOJI_GAME_QUESTIONS):
         user, uid = get_user_by_tg(update)
         user["games"]["emoji_game"] = True
+        context.user_data.pop("game", None)
         save_data()
         await update.message.reply_text(
             "Игра завершена!",
@@ -786,7 +1546,9 @@ async def send_emoji_question(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return MAIN_MENU
 
-    emoji_str, ans = EMOJI_GAME_QUESTIONS[idx]
+    context.user_data["game"] = GAME_EMOJI_Q
+    context.user_data["asked_at"] = time.monotonic()
+    emoji_str = EMOJI_GAME_QUESTIONS[idx][0]
     await update.message.reply_text(
         f"Задание {idx+1}/{len(EMOJI_GAME_QUESTIONS)}\n"
         f"{emoji_str}\n\n"
@@ -804,39 +1566,19 @@ async def game_emoji_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # выход в меню игр
     if text.strip().lower() == "🔙 в меню".lower():
+        context.user_data.pop("game", None)
         await update.message.reply_text("Меню игр:", reply_markup=online_games_menu())
         return MAIN_MENU
 
     idx = context.user_data.get("emoji_index", 0)
-    emoji_str, ans = EMOJI_GAME_QUESTIONS[idx]
+    question = EMOJI_GAME_QUESTIONS[idx]
     user, uid = get_user_by_tg(update)
 
-    user_answer = normalize_answer(text)
-    correct_main = normalize_answer(ans)
-
-    # базовый вариант
-    correct_variants = {correct_main}
-
-    # ===== ДОПОЛНИТЕЛЬНЫЕ ВАРИАНТЫ =====
-
-    # 1) Первый вопрос — «Сто шагов назад»
-    if idx == 0:
-        correct_variants.add(normalize_answer("100 шагов назад"))
-
-    # 2) Второй вопрос — «Дожди пистолеты»
-    if idx == 1:
-        correct_variants.add(normalize_answer("дожди-пистолеты"))
-        correct_variants.add(normalize_answer("дожди - пистолеты"))
-
-    # 3) Третий вопрос — «Солнышко в руках»
-    if idx == 2:
-        correct_variants.add(normalize_answer("солнышко"))
-
-    # ===================================
-
     # проверяем правильность
-    if user_answer in correct_variants:
-        user["points"] += 2
+    correct = answer_matcher(question).match(text)
+    record_answer("emoji", idx, fold_answer(text), correct, context)
+    if correct:
+        add_points(uid, 2, "game", update.effective_user.id)
         save_data()
         await update.message.reply_text("Правильно! Держи + 2 балла 🎶✨")
     else:
@@ -846,6 +1588,166 @@ async def game_emoji_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["emoji_index"] = idx + 1
     return await send_emoji_question(update, context)
 
+# =============================
+#   СТАТИСТИКА ПО ВОПРОСАМ
+# =============================
+
+GAME_TITLES = {
+    "truth": "Где правда?",
+    "binary": "Расшифруй код",
+    "headline": "Правда или ложь",
+    "emoji": "Угадай мелодию",
+}
+# Корзины времени ответа, сек: до 5, до 15, до 30, до 60 и дольше
+ANSWER_TIME_BUCKETS = (5, 15, 30, 60)
+# Сколько разных ответов помнить на вопрос — остальные считаются одной строкой «другое»
+ANSWER_VARIANTS_MAX = 20
+
+# question_stats: {"игра:номер": {"n": попыток, "ok": верных, "t": сумма секунд,
+#                                 "tn": ответов с замером, "tb": [корзины времени], "a": {ответ: раз}}}
+# Меняется только в потоке бота, поэтому без блокировок; на диск — вместе с flush() persistence.
+question_stats = {}
+question_stats_dirty = False
+
+def question_stats_path(worker: int = None) -> str:
+    # у воркеров у каждого свой файл, сводка их складывает
+    suffix = f".w{worker}" if worker is not None else ""
+    return f"{os.path.splitext(DATA_FILE)[0]}_questions{suffix}.json"
+
+def own_question_stats_path() -> str:
+    return question_stats_path(worker_index if store is not None else None)
+
+def record_answer(game: str, idx: int, answer: str, correct: bool, context: ContextTypes.DEFAULT_TYPE):
+    global question_stats_dirty
+    key = f"{game}:{idx}"
+    stats = question_stats.get(key)
+    if stats is None:
+        stats = question_stats[key] = {
+            "n": 0, "ok": 0, "t": 0.0, "tn": 0, "tb": [0] * (len(ANSWER_TIME_BUCKETS) + 1), "a": {},
+        }
+    stats["n"] += 1
+    stats["ok"] += correct
+    answers = stats["a"]
+    answer = answer[:40]
+    if answer not in answers and len(answers) >= ANSWER_VARIANTS_MAX:
+        answer = "другое"
+    answers[answer] = answers.get(answer, 0) + 1
+
+    asked_at = context.user_data.pop("asked_at", None)
+    if asked_at is not None:
+        spent = time.monotonic() - asked_at
+        stats["t"] += spent
+        stats["tn"] += 1
+        stats["tb"][bisect.bisect_right(ANSWER_TIME_BUCKETS, spent)] += 1
+    question_stats_dirty = True
+
+def read_question_stats(path: str) -> dict:
+    """
+    Счётчики из файла; None — файл не читается или обрезан.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            stats = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Статистика вопросов {path} не читается: {e}")
+        return None
+    if not isinstance(stats, dict):
+        print(f"Статистика вопросов {path} не читается: не словарь")
+        return None
+    return stats
+
+def load_question_stats():
+    global question_stats
+    path = own_question_stats_path()
+    if not os.path.exists(path):
+        return
+    stats = read_question_stats(path)
+    if stats is None:
+        # статистика — не повод не запускаться: начинаем с нуля, а испорченный
+        # файл откладываем, чтобы первый же flush его не затёр
+        print(f"Начинаю статистику заново, старый файл — {path}.bad")
+        try:
+            os.replace(path, path + ".bad")
+        except OSError:
+            pass
+        stats = {}
+    question_stats = stats
+
+def flush_question_stats():
+    global question_stats_dirty
+    if not question_stats_dirty:
+        return
+    question_stats_dirty = False
+    path = own_question_stats_path()
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(question_stats, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(path + ".tmp", path)
+
+def merge_question_stats(total: dict, part: dict):
+    for key, stats in part.items():
+        into = total.setdefault(key, {"n": 0, "ok": 0, "t": 0.0, "tn": 0, "tb": [0] * len(stats["tb"]), "a": {}})
+        for field in ("n", "ok", "t", "tn"):
+            into[field] += stats[field]
+        into["tb"] = [a + b for a, b in zip(into["tb"], stats["tb"])]
+        for answer, count in stats["a"].items():
+            into["a"][answer] = into["a"].get(answer, 0) + count
+
+def all_question_stats() -> dict:
+    """
+    Свои счётчики из памяти плюс файлы остальных воркеров.
+    """
+    total = {}
+    merge_question_stats(total, question_stats)
+    if store is not None:
+        own = own_question_stats_path()
+        for path in glob.glob(f"{os.path.splitext(DATA_FILE)[0]}_questions.w*.json"):
+            if path != own:
+                # файл соседа может быть недописан — тогда без него
+                part = read_question_stats(path)
+                if part is not None:
+                    merge_question_stats(total, part)
+    return total
+
+def question_lists() -> dict:
+    return {
+        "truth": TRUTH_GAME_QUESTIONS,
+        "binary": BINARY_GAME_QUESTIONS,
+        "headline": HEADLINE_GAME_QUESTIONS,
+        "emoji": EMOJI_GAME_QUESTIONS,
+    }
+
+async def admin_question_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /qstats — доля верных ответов и среднее время по каждому вопросу,
+    /qstats <truth|binary|headline|emoji> — ещё и самые частые ответы.
+    """
+    tg_id = update.effective_user.id
+    if tg_id not in ADMIN_IDS:
+        await update.message.reply_text("Эта функция доступна только организаторам.")
+        return
+
+    only = context.args[0] if context.args and context.args[0] in GAME_TITLES else None
+    stats = all_question_stats()
+    lines = []
+    for game, questions in question_lists().items():
+        if only and game != only:
+            continue
+        lines.append(f"«{GAME_TITLES[game]}»:")
+        for idx in range(len(questions)):
+            s = stats.get(f"{game}:{idx}")
+            if not s:
+                lines.append(f"{idx + 1}. ответов нет")
+                continue
+            line = f"{idx + 1}. ответов {s['n']}, верно {100 * s['ok'] // s['n']}%"
+            if s["tn"]:
+                line += f", в среднем {s['t'] / s['tn']:.0f} с"
+            lines.append(line)
+            if only:
+                top = sorted(s["a"].items(), key=lambda kv: -kv[1])[:5]
+                lines.append("   " + ", ".join(f"«{a}» {c}" for a, c in top))
+        lines.append("")
+    await update.message.reply_text("\n".join(lines).strip()[:4000] or "Данных пока нет.")
+
 # =============================
 #      ОФФЛАЙН «ИГРАТЬ»
 # =============================
@@ -862,7 +1764,7 @@ async def play_offline(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Вот список активностей, за которые можно получить баллы:\n"
         "— Расшифровать бинарный код ✔️ (2 этаж)\n"
-        "— Найти все 6 QR-кодов 🔍 (везде)\n"
+        "— Найти все 6 QR-кодов 🔍 (везде) — баллы начислятся сами при сканировании\n"
         "— Угадать что ИИ, а что реальность 🎭 (3 этаж)\n"
         "— Отличить настоящие новости от выдуманных ⚡ (3 этаж)\n"
         "— Попасть кольцом 💍 (3 этаж)\n"
@@ -975,15 +1877,8 @@ async def admin_add_get_value(update: Update, context: ContextTypes.DEFAULT_TYPE
         context.user_data.pop("admin_target_uid", None)
         return MAIN_MENU
 
-    # гарантируем, что points — число
-    old_points_raw = users[uid].get("points", 0)
-    try:
-        old_points = int(old_points_raw)
-    except (TypeError, ValueError):
-        old_points = 0
-
-    new_points = old_points + delta
-    users[uid]["points"] = new_points
+    new_points = add_points(uid, delta, "admin", update.effective_user.id)
+    old_points = new_points - delta
     save_data()
 
     # меню для АДМИНА, не игрока
@@ -1002,6 +1897,394 @@ async def admin_add_get_value(update: Update, context: ContextTypes.DEFAULT_TYPE
     context.user_data.pop("admin_target_uid", None)
     return MAIN_MENU
 
+# =============================
+#   ЖУРНАЛ ИЗМЕНЕНИЙ БАЛЛОВ
+# =============================
+
+AUDIT_SOURCES = {"game": "игра", "admin": "админ", "qr": "QR", "undo": "отмена", "restore": "откат"}
+
+class AuditLog:
+    """
+    Журнал изменений баллов в SQLite. Только дописывается: отмена — это новая
+    запись с обратным знаком и ссылкой undo_of. Индексы по игроку и по автору
+    дают выборки «последние N» за O(log n); уникальный индекс по undo_of
+    не даёт отменить одну запись дважды. /restore оставляет метку с source
+    "restore" (target 0, delta 0): всё, что раньше неё, отменять уже нельзя.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS audit (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts REAL NOT NULL,
+            actor INTEGER,
+            target INTEGER NOT NULL,
+            delta INTEGER NOT NULL,
+            source TEXT NOT NULL,
+            undo_of INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS audit_target ON audit (target, id);
+        CREATE INDEX IF NOT EXISTS audit_actor ON audit (actor, id);
+        CREATE UNIQUE INDEX IF NOT EXISTS audit_undo ON audit (undo_of) WHERE undo_of IS NOT NULL;
+    """
+
+    # запись + id её отмены (NULL — не отменена)
+    SELECT = (
+        "SELECT a.id, a.ts, a.actor, a.target, a.delta, a.source, a.undo_of, u.id "
+        "FROM audit a LEFT JOIN audit u ON u.undo_of = a.id "
+    )
+
+    def __init__(self, db: sqlite3.Connection, path: str = None):
+        self.db = db
+        self.path = path
+        self.db.executescript(self.SCHEMA)
+
+    def append(self, actor, target, delta: int, source: str, undo_of: int = None) -> int:
+        cur = self.db.execute(
+            "INSERT INTO audit (ts, actor, target, delta, source, undo_of) VALUES (?, ?, ?, ?, ?, ?)",
+            (round(time.time(), 3), actor, target, delta, source, undo_of),
+        )
+        return cur.lastrowid
+
+    def by_target(self, uid, limit: int = 20):
+        return self.db.execute(
+            self.SELECT + "WHERE a.target = ? ORDER BY a.id DESC LIMIT ?", (uid, limit)
+        ).fetchall()
+
+    def by_actor(self, tg_id: int, limit: int = 20):
+        return self.db.execute(
+            self.SELECT + "WHERE a.actor = ? ORDER BY a.id DESC LIMIT ?", (tg_id, limit)
+        ).fetchall()
+
+    def undoable(self, actor: int, limit: int):
+        """
+        Последние неотменённые ручные начисления этого админа после последнего
+        отката: то, что было до него, откат уже вернул или стёр.
+        """
+        return self.db.execute(
+            self.SELECT + "WHERE a.actor = ? AND a.source = 'admin' AND u.id IS NULL "
+            "AND a.id > (SELECT COALESCE(MAX(id), 0) FROM audit WHERE source = 'restore') "
+            "ORDER BY a.id DESC LIMIT ?",
+            (actor, limit),
+        ).fetchall()
+
+    def close(self):
+        self.db.close()
+
+# Журнал лежит рядом с DATA_FILE, у воркеров — в общей базе
+audit = None
+
+def audit_log() -> AuditLog:
+    global audit
+    if store is not None:
+        return store.audit
+    path = os.path.splitext(DATA_FILE)[0] + "_audit.sqlite"
+    if audit is None or audit.path != path:
+        if audit is not None:
+            audit.close()
+        db = sqlite3.connect(path, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        audit = AuditLog(db, path)
+    return audit
+
+def close_audit():
+    global audit
+    if audit is not None:
+        audit.close()
+        audit = None
+
+def format_audit_entry(row) -> str:
+    entry_id, ts, actor, target, delta, source, undo_of, undone_by = row
+    when = time.strftime("%d.%m %H:%M:%S", time.localtime(ts))
+    if source == "restore":
+        return f"#{entry_id} {when} откат из резервной копии, от {actor}"
+    name = users.get(target, {}).get("name", "?")
+    line = f"#{entry_id} {when} {delta:+d} → {name} (ID #{target}), {AUDIT_SOURCES.get(source, source)}"
+    if actor is not None:
+        line += f", от {actor}"
+    if undo_of is not None:
+        line += f", отменяет #{undo_of}"
+    if undone_by is not None:
+        line += f" — отменено (#{undone_by})"
+    return line
+
+async def admin_audit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /audit <ID игрока> — последние изменения его баллов,
+    /audit by <tg_id> — изменения, сделанные этим человеком, /audit — свои.
+    """
+    tg_id = update.effective_user.id
+    if tg_id not in ADMIN_IDS:
+        await update.message.reply_text("Эта функция доступна только организаторам.")
+        return
+
+    args = context.args
+    if len(args) == 2 and args[0] == "by" and args[1].isdigit():
+        title, rows = f"Изменения от {args[1]}:", audit_log().by_actor(int(args[1]))
+    elif len(args) == 1 and args[0].lstrip("#").isdigit():
+        uid = int(args[0].lstrip("#"))
+        title, rows = f"Изменения баллов игрока #{uid}:", audit_log().by_target(uid)
+    elif not args:
+        title, rows = "Ваши последние изменения:", audit_log().by_actor(tg_id)
+    else:
+        await update.message.reply_text("Формат: /audit <ID игрока>, /audit by <tg_id> или /audit")
+        return
+
+    lines = [title] + [format_audit_entry(row) for row in rows] if rows else [title, "записей нет"]
+    await update.message.reply_text("\n".join(lines)[:4000])
+
+async def admin_undo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /undo [N] [tg_id] — отменяет последние N ручных начислений (свои или указанного
+    волонтёра) встречными записями. Сами записи остаются в журнале.
+    Записи до последнего /restore не отменяются.
+    """
+    tg_id = update.effective_user.id
+    if tg_id not in ADMIN_IDS:
+        await update.message.reply_text("Эта функция доступна только организаторам.")
+        return
+
+    args = context.args
+    if len(args) > 2 or not all(arg.isdigit() for arg in args):
+        await update.message.reply_text("Формат: /undo [сколько] [tg_id автора]")
+        return
+    count = min(int(args[0]), 20) if args else 1
+    actor = int(args[1]) if len(args) > 1 else tg_id
+
+    lines = []
+    for row in audit_log().undoable(actor, count):
+        entry_id, target, delta = row[0], row[3], row[4]
+        if target not in users:
+            continue
+        try:
+            new_points = add_points(target, -delta, "undo", tg_id, undo_of=entry_id)
+        except sqlite3.IntegrityError:
+            # эту запись только что отменил кто-то другой
+            continue
+        lines.append(f"#{entry_id}: {users[target]['name']} (ID #{target}) {-delta:+d}, теперь {new_points}")
+
+    if not lines:
+        await update.message.reply_text("Отменять нечего.")
+        return
+    save_data()
+    await update.message.reply_text("Отменено:\n" + "\n".join(lines))
+
+# =============================
+#      РЕЗЕРВНЫЕ КОПИИ
+# =============================
+
+# Копии — сжатые снимки с временем в имени: 20261019-213000.snap.gz
+# (у воркеров — копия общей базы, .sqlite.gz). За последний час хранятся все,
+# дальше — по одной на час, пока не старше BACKUP_KEEP_HOURS.
+BACKUP_NAME_RE = re.compile(r"^(\d{8}-\d{6})\.(snap|sqlite)\.gz$")
+BACKUP_RECENT = 3600
+
+# заголовок последнего скопированного снимка — без изменений копию не пишем
+last_backup_header = None
+backup_running = False
+# job и /restore могут писать копии одновременно — каждый в своём потоке
+backup_lock = threading.Lock()
+
+def backup_dir() -> str:
+    if not BACKUP_DIR:
+        return os.path.splitext(DATA_FILE)[0] + "_backups"
+    # события — в своих подкаталогах, имена копий у них совпадают
+    return os.path.join(BACKUP_DIR, EVENT_SLUG) if EVENT_SLUG else BACKUP_DIR
+
+def list_backups(folder: str) -> list:
+    """
+    [(время, имя)] от новых к старым.
+    """
+    result = []
+    if os.path.isdir(folder):
+        for name in os.listdir(folder):
+            m = BACKUP_NAME_RE.match(name)
+            if m:
+                result.append((time.mktime(time.strptime(m.group(1), "%Y%m%d-%H%M%S")), name))
+    result.sort(reverse=True)
+    return result
+
+def rotate_backups(folder: str, now: float):
+    kept_hours = set()
+    for stamp, name in list_backups(folder):
+        age = now - stamp
+        if age <= BACKUP_RECENT:
+            continue
+        hour = int(stamp // 3600)
+        if age <= BACKUP_KEEP_HOURS * 3600 and hour not in kept_hours:
+            # самая свежая копия своего часа
+            kept_hours.add(hour)
+            continue
+        os.remove(os.path.join(folder, name))
+
+def read_current_snapshot() -> bytes:
+    """
+    Последний целый снимок с диска. save_data подменяет файл атомарно, так что
+    прочитанное — состояние на момент одной из записей; .prev — если попали
+    между двумя os.replace или текущий испорчен.
+    """
+    path = snapshot_path()
+    for candidate in (path, path + ".prev"):
+        try:
+            with open(candidate, "rb") as f:
+                raw = f.read()
+            snapshot_payload(raw)
+            return raw
+        except (OSError, ValueError, struct.error):
+            continue
+    return None
+
+def write_backup(force: bool = False, raw: bytes = None) -> str:
+    """
+    Снимает копию в потоке: чтение, сжатие и запись не трогают event loop.
+    raw — уже готовый снимок вместо файла с диска.
+    Возвращает имя файла или None, если с прошлой копии ничего не изменилось.
+    """
+    with backup_lock:
+        return write_backup_locked(force, raw)
+
+def write_backup_locked(force: bool, raw: bytes = None) -> str:
+    global last_backup_header
+    folder = backup_dir()
+    os.makedirs(folder, exist_ok=True)
+    now = time.time()
+    if store is None:
+        if raw is None:
+            raw = read_current_snapshot()
+        if raw is None:
+            return None
+        header = raw[:SNAPSHOT_HEADER.size]
+        if header == last_backup_header and not force:
+            return None
+        suffix = ".snap.gz"
+    else:
+        # у воркеров состояние в SQLite — её backup API даёт согласованную копию
+        fd, tmp_db = tempfile.mkstemp(suffix=".sqlite", dir=folder)
+        os.close(fd)
+        try:
+            src = sqlite3.connect(store.path)
+            dst = sqlite3.connect(tmp_db)
+            try:
+                src.backup(dst)
+            finally:
+                dst.close()
+                src.close()
+            with open(tmp_db, "rb") as f:
+                raw = f.read()
+        finally:
+            os.remove(tmp_db)
+        header = None
+        suffix = ".sqlite.gz"
+
+    name = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + suffix
+    path = os.path.join(folder, name)
+    # две копии в одну секунду (job и /restore) — вторая получает следующую
+    while os.path.exists(path):
+        now += 1
+        name = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + suffix
+        path = os.path.join(folder, name)
+    with open(path + ".tmp", "wb") as f:
+        f.write(gzip.compress(raw, compresslevel=6))
+    os.replace(path + ".tmp", path)
+    last_backup_header = header
+    rotate_backups(folder, now)
+    return name
+
+async def backup_job(context: ContextTypes.DEFAULT_TYPE):
+    global backup_running
+    # медленный диск не должен копить очередь из копий
+    if backup_running:
+        return
+    backup_running = True
+    try:
+        await asyncio.to_thread(write_backup)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Резервная копия не записана: {e}")
+    finally:
+        backup_running = False
+
+def read_backup(name: str) -> dict:
+    path = os.path.join(backup_dir(), name)
+    with open(path, "rb") as f:
+        return decode_state_file(path, f.read())
+
+def format_backup_age(seconds: float) -> str:
+    if seconds < 3600:
+        return f"{int(seconds // 60)} мин назад"
+    return f"{seconds / 3600:.1f} ч назад"
+
+async def admin_restore(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /restore — последние копии, /restore <имя> — вернуть баллы и игроков из копии.
+    Текущее состояние перед этим само уходит в копию, так что откат обратим.
+    Диалоги и «живые» таблицы остаются текущими.
+    """
+    global users, tg_to_user, next_uid, qr_redeemed
+    tg_id = update.effective_user.id
+    if tg_id not in ADMIN_IDS:
+        await update.message.reply_text("Эта функция доступна только организаторам.")
+        return
+
+    folder = backup_dir()
+    backups = await asyncio.to_thread(list_backups, folder)
+    if not context.args:
+        now = time.time()
+        lines = [
+            f"{name} — {format_backup_age(now - stamp)}"
+            for stamp, name in backups[:15]
+        ]
+        if not lines:
+            await update.message.reply_text("Резервных копий пока нет.")
+            return
+        await update.message.reply_text(
+            "Резервные копии:\n" + "\n".join(lines) + "\n\nВосстановить: /restore <имя>"
+        )
+        return
+
+    name = context.args[0]
+    if name not in {n for _, n in backups}:
+        await update.message.reply_text("Такой копии нет, список — /restore")
+        return
+    if store is not None or name.endswith(".sqlite.gz"):
+        await update.message.reply_text(
+            "В режиме воркеров копия — это база целиком: остановите бота "
+            f"и распакуйте {name} на место {store.path if store else STORE_DB}."
+        )
+        return
+
+    try:
+        data = await asyncio.to_thread(read_backup, name)
+    except (OSError, ValueError, EOFError, struct.error) as e:
+        await update.message.reply_text(f"Копия {name} не читается: {e}")
+        return
+
+    # то, что сейчас, — тоже в копию, на случай если откатились не туда. Снимок
+    # берём из памяти и подменяем состояние без await между ними, иначе между
+    # копией и откатом успеет проскочить чьё-нибудь начисление
+    current_raw = encode_snapshot()
+    users = data["users"]
+    tg_to_user = data["tg_to_user"]
+    next_uid = max(next_uid, data["next_uid"])
+    qr_redeemed = {(uid, code) for uid, code in data["qr_redeemed"]}
+    recount_teams()
+    rebuild_prereg_index()
+    mark_scores_changed()
+    # метка в журнале: /undo не должен отменять начисления, которые откат уже убрал
+    audit_log().append(tg_id, 0, 0, "restore")
+    save_data()
+
+    try:
+        current = await asyncio.to_thread(write_backup, True, current_raw)
+    except OSError as e:
+        await update.message.reply_text(
+            f"Восстановлено из {name}: игроков {len(users)}.\n"
+            f"Копию состояния до отката записать не удалось: {e}"
+        )
+        return
+    await update.message.reply_text(
+        f"Восстановлено из {name}: игроков {len(users)}.\n"
+        f"Состояние до отката — в копии {current}."
+    )
+
 # =============================
 #      ВОЗВРАТ В МЕНЮ
 # =============================
@@ -1096,23 +2379,8 @@ async def admin_top_teams(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Эта функция доступна только организаторам.")
         return MAIN_MENU
 
-    red = []
-    blue = []
-
-    for uid, info in users.items():
-        if info.get("mode") != "offline":
-            continue
-        team = info.get("team")
-        if team == "red":
-            red.append((uid, info["name"], info.get("points", 0)))
-        elif team == "blue":
-            blue.append((uid, info["name"], info.get("points", 0)))
-
-    red.sort(key=lambda x: x[2], reverse=True)
-    blue.sort(key=lambda x: x[2], reverse=True)
-
-    red_top = red[:5]
-    blue_top = blue[:5]
+    red_top = team_entries("red")[:5]
+    blue_top = team_entries("blue")[:5]
 
     def format_team(title, lst, emoji):
         if not lst:
@@ -1137,55 +2405,2324 @@ async def admin_top_teams(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return MAIN_MENU
 
 # =============================
-#            MAIN
+#   «ЖИВАЯ» ТУРНИРНАЯ ТАБЛИЦА
 # =============================
 
-def main():
-    load_data()
-    app = Application.builder().token(TOKEN).build()
+# {ключ live_boards: топ, который сейчас показан в этих живых таблицах}
+live_last_shown = {}
 
-    conv = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
-        states={
-            CHOOSING_LOCATION: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, choose_location),
-            ],
-            MAIN_MENU: [
-                # Выбор режима
-                MessageHandler(filters.Regex("^Я на вечеринке$"), choose_location),
-                MessageHandler(filters.Regex("^Я на удаленке$"), choose_location),
-
-                # Регистрация
-                MessageHandler(filters.Regex("^✍️ Регистрация$"), registration),
-
-                # Офлайн
-                MessageHandler(filters.Regex("^👁 Играть$"), play_offline),
-                MessageHandler(filters.Regex("^ℹ️ Правила игры$"), rules_offline),
-
-                # Онлайн общее
-                MessageHandler(filters.Regex("^Играть$"), online_play),
-                MessageHandler(filters.Regex("^Мои баллы$"), my_points),
-                MessageHandler(filters.Regex("^🧮 Мои баллы$"), my_points),
-                MessageHandler(filters.Regex("^Турнирная таблица$"), leaderboard),
-                MessageHandler(filters.Regex("^🏆 Турнирная таблица$"), leaderboard),
-
-                # Онлайн игры
-                MessageHandler(filters.Regex("^Где правда\\?$"), game_truth_start),
-                MessageHandler(filters.Regex("^Расшифруй код$"), game_binary_start),
-                MessageHandler(filters.Regex("^Правда или ложь$"), game_headline_start),
-                MessageHandler(filters.Regex("^Угадай мелодию$"), game_emoji_start),
-
-                # Админ
-                MessageHandler(filters.Regex("^➕ Добавить баллы$"), admin_add_start),
-                MessageHandler(filters.Regex("^Список участников$"), admin_list_participants),
-                MessageHandler(filters.Regex("^Топ-5 игроков в каждой команде$"), admin_top_teams),
-
-                # Назад
-                MessageHandler(filters.Regex("^🔙 В меню$"), back_to_menu),
-
-                # Назад
-                MessageHandler(filters.Regex("^🔙 В меню$"), back_to_menu),
+def live_board_key(mode: str, app: Application) -> str:
+    label = app.bot_data.get("bot_label")
+    return f"{mode}@{label}" if label else mode
+
+def live_board_text(mode: str, top) -> str:
+    return "📌 " + format_leaderboard(mode, top) + "\n\n(обновляется автоматически)"
+
+@require_registered
+async def live_board_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /live — подписаться на закреплённую таблицу, которую бот сам обновляет.
+    Повторная команда отписывает.
+    """
+    user, uid = get_user_by_tg(update)
+    mode = user["mode"]
+    chat_id = update.effective_chat.id
+    boards = live_boards.setdefault(live_board_key(mode, context.application), {})
+
+    if chat_id in boards:
+        boards.pop(chat_id)
+        save_data()
+        await update.message.reply_text("Живая таблица отключена.")
+        return
+
+    msg = await update.message.reply_text(live_board_text(mode, top_entries(mode)))
+    try:
+        await context.bot.pin_chat_message(chat_id, msg.message_id, disable_notification=True)
+    except TelegramError:
+        pass
+    boards[chat_id] = msg.message_id
+    save_data()
+
+async def refresh_live_boards(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Раз в LIVE_BOARD_INTERVAL правит подписанные сообщения — только если топ-10 изменился.
+    """
+    changed = False
+    own_label = context.application.bot_data.get("bot_label")
+    # live_board_toggle другого бота может добавить ключ, пока мы ждём на await
+    for key, boards in list(live_boards.items()):
+        mode, _, label = key.partition("@")
+        if not boards or (label or None) != own_label:
+            continue
+        top = top_entries(mode)
+        if live_last_shown.get(key) == top:
+            continue
+        text = live_board_text(mode, top)
+
+        # топ считается показанным, только если дошёл до всех — иначе повтор в следующий раз
+        delivered = True
+        for chat_id, msg_id in list(boards.items()):
+            try:
+                await context.bot.edit_message_text(text, chat_id=chat_id, message_id=msg_id)
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    # сообщение удалили — подписка больше не нужна
+                    boards.pop(chat_id, None)
+                    changed = True
+            except Forbidden:
+                boards.pop(chat_id, None)
+                changed = True
+            except RetryAfter:
+                # упёрлись во flood control — остальное в следующий проход
+                delivered = False
+                break
+            except TelegramError as e:
+                print(f"Живая таблица в чате {chat_id} не обновлена: {e}")
+                delivered = False
+            await asyncio.sleep(1 / LIVE_EDITS_PER_SEC)
+        if delivered:
+            live_last_shown[key] = top
+
+    if changed:
+        save_data()
+
+# =============================
+#   ИНЛАЙН-ЗАПРОС «@бот top»
+# =============================
+
+MODE_TITLES = {"online": "Онлайн", "offline": "Вечеринка"}
+
+async def inline_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    «@бот top» в любом чате — общие таблицы из готового топа, одинаковые для всех,
+    поэтому их кэширует сам Telegram. «@бот me» — личные баллы, кэш только свой.
+    """
+    query = update.inline_query.query.strip().lower()
+
+    if query in ("me", "я"):
+        user, uid = get_user_by_tg(update)
+        if not user:
+            text = "Я ещё не зарегистрирован в игре KTS."
+        else:
+            text = f"{user['name']} (ID #{uid}): {user['points']} баллов"
+        await update.inline_query.answer(
+            [InlineQueryResultArticle(
+                id="me",
+                title="Мои баллы",
+                description=text,
+                input_message_content=InputTextMessageContent(text),
+            )],
+            cache_time=5,
+            is_personal=True,
+        )
+        return
+
+    results = []
+    for mode, title in MODE_TITLES.items():
+        top = top_entries(mode)
+        text = format_leaderboard(mode, top)
+        leader = f"1. {top[0][1]} — {top[0][2]}" if top else "Пока нет игроков"
+        results.append(InlineQueryResultArticle(
+            id=f"top_{mode}",
+            title=f"🏆 Турнирная таблица: {title}",
+            description=leader,
+            input_message_content=InputTextMessageContent(text),
+        ))
+    await update.inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=False)
+
+# =============================
+#   HTTP-ТАБЛО ДЛЯ БОЛЬШОГО ЭКРАНА
+# =============================
+
+# (scores_version, json, html) — собирается в потоке бота, HTTP-поток только читает.
+# Кортеж подменяется целиком, поэтому читателю не нужны блокировки.
+scoreboard_published = (-1, b"{}", b"")
+SCOREBOARD_BOOT = int(time.time())
+
+def scoreboard_data() -> dict:
+    teams = {}
+    for team in ("red", "blue"):
+        members = team_entries(team)
+        teams[team] = {
+            "total": team_stats[team]["total"],
+            "count": team_stats[team]["count"],
+            "top": [{"id": uid, "name": name, "points": pts} for uid, name, pts in members[:10]],
+        }
+    return {
+        "version": scores_version,
+        "online_top": [
+            {"id": uid, "name": name, "points": pts}
+            for uid, name, pts in top_entries("online")
+        ],
+        "teams": teams,
+    }
+
+def scoreboard_html(data: dict) -> str:
+    def rows(entries):
+        if not entries:
+            return "<li>Пока нет участников</li>"
+        return "".join(
+            f"<li>{html.escape(e['name'])} — {e['points']}</li>" for e in entries
+        )
+
+    red, blue = data["teams"]["red"], data["teams"]["blue"]
+    return (
+        "<!doctype html><html><head><meta charset='utf-8'>"
+        "<meta http-equiv='refresh' content='5'><title>KTS party</title>"
+        "<style>body{font-family:sans-serif;font-size:2vw;display:flex;gap:4vw}</style>"
+        "</head><body>"
+        f"<div><h2>🔴 Красные: {red['total']}</h2><ol>{rows(red['top'])}</ol></div>"
+        f"<div><h2>🔵 Синие: {blue['total']}</h2><ol>{rows(blue['top'])}</ol></div>"
+        f"<div><h2>Онлайн</h2><ol>{rows(data['online_top'])}</ol></div>"
+        "</body></html>"
+    )
+
+async def publish_scoreboard(context: ContextTypes.DEFAULT_TYPE = None):
+    global scoreboard_published
+    if scoreboard_published[0] == scores_version:
+        return
+    data = scoreboard_data()
+    scoreboard_published = (
+        data["version"],
+        json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode(),
+        scoreboard_html(data).encode(),
+    )
+
+class ScoreboardHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        version, body_json, body_html = scoreboard_published
+        path = self.path.split("?", 1)[0]
+        if path in ("/", "/index.html"):
+            body, ctype = body_html, "text/html; charset=utf-8"
+        elif path == "/scoreboard.json":
+            body, ctype = body_json, "application/json; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+
+        # версия начинается с нуля после рестарта, поэтому в ETag есть и время запуска
+        etag = f'"{SCOREBOARD_BOOT}-{version}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # экраны опрашивают часто — не засоряем консоль
+        pass
+
+def start_scoreboard_server(host: str, port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), ScoreboardHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Табло: http://{host}:{server.server_address[1]}/")
+    return server
+
+# =============================
+#   QR-КОДЫ: ССЫЛКИ /start <код>
+# =============================
+
+def qr_signature(code: int) -> str:
+    digest = hmac.new(QR_SECRET.encode(), f"qr{code}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode()[:16]
+
+def qr_payload(code: int) -> str:
+    # deep link допускает только A-Za-z0-9_- и до 64 символов
+    return f"qr{code}-{qr_signature(code)}"
+
+def parse_qr_payload(payload: str):
+    """
+    Номер кода, если подпись верна, иначе None.
+    """
+    m = re.match(r"^qr(\d+)-([A-Za-z0-9_-]{16})$", payload)
+    if not m:
+        return None
+    code = int(m.group(1))
+    if not 1 <= code <= QR_CODES_COUNT:
+        return None
+    if not hmac.compare_digest(m.group(2), qr_signature(code)):
+        return None
+    return code
+
+def redeem_qr(uid, code: int) -> bool:
+    """
+    Отмечает код найденным. False — этот игрок его уже сканировал.
+    """
+    if (uid, code) in qr_redeemed:
+        return False
+    # у воркеров решает первичный ключ в общей базе — повторный скан не пройдёт и там
+    fresh = store.redeem_qr(uid, code) if store is not None else True
+    qr_redeemed.add((uid, code))
+    return fresh
+
+async def qr_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /start qrN-подпись — начисляет баллы за найденный QR-код.
+    Работает в любом состоянии диалога и не сбивает его.
+    """
+    code = parse_qr_payload(context.args[0])
+    if code is None:
+        # не наш код — пусть обычный /start покажет меню
+        return
+
+    user, uid = get_user_by_tg(update)
+    if not user:
+        await update.message.reply_text(
+            "Это QR-код квеста! Сначала зарегистрируйтесь, "
+            "а потом отсканируйте его ещё раз."
+        )
+        return
+
+    if user["mode"] != "offline":
+        await update.message.reply_text("QR-квест — для гостей на самой вечеринке 🙂")
+        raise ApplicationHandlerStop
+
+    if not redeem_qr(uid, code):
+        await update.message.reply_text("Этот QR-код уже засчитан 🙂")
+        raise ApplicationHandlerStop
+
+    add_points(uid, QR_POINTS, "qr", update.effective_user.id)
+    save_data()
+
+    found = sum(1 for c in range(1, QR_CODES_COUNT + 1) if (uid, c) in qr_redeemed)
+    await update.message.reply_text(
+        f"QR-код найден! +{QR_POINTS} 🔍\n"
+        f"Найдено {found} из {QR_CODES_COUNT}."
+    )
+    raise ApplicationHandlerStop
+
+async def admin_qr_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tg_id = update.effective_user.id
+    if tg_id not in ADMIN_IDS:
+        await update.message.reply_text("Эта функция доступна только организаторам.")
+        return
+
+    lines = ["Ссылки для QR-кодов:"]
+    for code in range(1, QR_CODES_COUNT + 1):
+        lines.append(f"{code}. https://t.me/{context.bot.username}?start={qr_payload(code)}")
+    await update.message.reply_text("\n".join(lines), disable_web_page_preview=True)
+
+# =============================
+#   АДМИН: СПИСОК ГОСТЕЙ ИЗ CSV
+# =============================
+
+TEAM_ALIASES = {
+    "red": "red", "красный": "red", "красная": "red", "к": "red", "🔴": "red",
+    "blue": "blue", "синий": "blue", "синяя": "blue", "с": "blue", "🔵": "blue",
+}
+
+def prereg_name_key(name: str) -> str:
+    return normalize_answer(name).replace("ё", "е")
+
+def index_prereg(uid):
+    user = users[uid]
+    if user.get("username"):
+        prereg_by_username[user["username"]] = uid
+    prereg_by_name.setdefault(prereg_name_key(user["name"]), []).append(uid)
+
+def rebuild_prereg_index():
+    prereg_by_username.clear()
+    prereg_by_name.clear()
+    for uid, user in users.items():
+        if user.get("prereg"):
+            index_prereg(uid)
+
+def find_prereg_by_name(name: str):
+    # тёзки в списке — не угадываем, кто есть кто: обычная регистрация с вопросом о браслете
+    uids = prereg_by_name.get(prereg_name_key(name))
+    return uids[0] if uids and len(uids) == 1 else None
+
+def claim_prereg(uid, tg_id: int):
+    """
+    Привязывает гостя из списка к его Telegram-аккаунту и убирает из индексов.
+    """
+    user = users[uid]
+    user.pop("prereg", None)
+    # теперь гость в игре — в счёт команды и в таблицы
+    team_attach(uid)
+    mark_scores_changed()
+    if prereg_by_username.get(user.get("username")) == uid:
+        del prereg_by_username[user["username"]]
+    key = prereg_name_key(user["name"])
+    uids = prereg_by_name.get(key, [])
+    if uid in uids:
+        uids.remove(uid)
+        if not uids:
+            del prereg_by_name[key]
+    tg_to_user[tg_id] = uid
+
+async def reply_prereg_done(update: Update, context: ContextTypes.DEFAULT_TYPE, uid):
+    user = users[uid]
+    team_text = "красной команде 🔴" if user["team"] == "red" else "синей команде 🔵"
+    await update.message.reply_text(
+        f"Нашли вас в списке гостей: {user['name']}.\n"
+        f"Ты в {team_text}!\n"
+        f"Твой ID: #{uid}",
+        reply_markup=offline_menu_for(update.effective_user.id)
+    )
+    return MAIN_MENU
+
+def parse_guest_csv(text: str):
+    """
+    Строки «имя, команда[, username]». Возвращает (гости, ошибки).
+    """
+    guests, errors = [], []
+    for lineno, row in enumerate(csv.reader(io.StringIO(text)), start=1):
+        row = [cell.strip() for cell in row]
+        if not any(row):
+            continue
+        if lineno == 1 and row[0].lower() in ("name", "имя"):
+            continue
+        if len(row) < 2:
+            errors.append(f"стр. {lineno}: нужно минимум имя и команда")
+            continue
+        name, team_raw = row[0], row[1].lower()
+        username = row[2].lstrip("@").lower() if len(row) > 2 and row[2] else None
+        if not validate_name(name):
+            errors.append(f"стр. {lineno}: некорректное имя «{name}»")
+            continue
+        if team_raw not in TEAM_ALIASES:
+            errors.append(f"стр. {lineno}: неизвестная команда «{row[1]}»")
+            continue
+        guests.append((name, TEAM_ALIASES[team_raw], username))
+    return guests, errors
+
+def import_guests(guests):
+    """
+    Заводит всех гостей разом: ID выдаются подряд, запись на диск одна.
+    Дубликат — тот же username, а без него — то же имя в той же команде
+    (среди уже заведённых офлайн-игроков и строк выше), так что повторная
+    загрузка того же файла ничего не добавляет.
+    Возвращает (добавлено, [имена пропущенных дубликатов]).
+    """
+    fresh, skipped = [], []
+    known_usernames = {u.get("username") for u in users.values() if u.get("username")}
+    known_names = {
+        (prereg_name_key(u["name"]), u.get("team")) for u in users.values() if u.get("mode") == "offline"
+    }
+    for name, team, username in guests:
+        name_key = (prereg_name_key(name), team)
+        if (username and username in known_usernames) or (not username and name_key in known_names):
+            skipped.append(name)
+            continue
+        fresh.append((name, team, username))
+        known_names.add(name_key)
+        if username:
+            known_usernames.add(username)
+
+    added = len(fresh)
+    uid = allocate_uids(added) if added else 0
+    for name, team, username in fresh:
+        user = make_user(name, "offline", team)
+        user["prereg"] = True
+        user["username"] = username
+        users[uid] = user
+        index_prereg(uid)
+        uid += 1
+
+    if added:
+        mark_scores_changed()
+        save_data()
+    return added, skipped
+
+async def admin_import_guests(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Админ присылает CSV-файл со списком гостей (имя, команда, username).
+    """
+    tg_id = update.effective_user.id
+    if tg_id not in ADMIN_IDS:
+        return
+
+    tg_file = await update.message.document.get_file()
+    raw = await tg_file.download_as_bytearray()
+    try:
+        text = bytes(raw).decode("utf-8-sig")
+    except UnicodeDecodeError:
+        await update.message.reply_text("Файл должен быть в кодировке UTF-8.")
+        raise ApplicationHandlerStop
+
+    guests, errors = parse_guest_csv(text)
+    added, skipped = import_guests(guests)
+
+    lines = [f"Импорт гостей: добавлено {added}, пропущено дубликатов {len(skipped)}."]
+    if skipped:
+        lines.append("Уже в списке: " + ", ".join(skipped[:20]) + (" и др." if len(skipped) > 20 else ""))
+    if errors:
+        lines.append(f"Ошибки ({len(errors)}):")
+        lines.extend(errors[:20])
+    await update.message.reply_text("\n".join(lines))
+    raise ApplicationHandlerStop
+
+# =============================
+#   ПРОСТАИВАЮЩИЕ СЕССИИ
+# =============================
+
+# {tg_id: время последнего апдейта} — только для тех, кто был активен недавно
+session_last_seen = {}
+
+def resumable_games():
+    # состояние игры -> (ключ индекса в user_data, отправка текущего вопроса)
+    return {
+        GAME_TRUTH_Q: ("truth_index", send_truth_question),
+        GAME_BINARY_Q: ("binary_index", send_binary_question),
+        GAME_HEADLINE_Q: ("headline_index", send_headline_question),
+        GAME_EMOJI_Q: ("emoji_index", send_emoji_question),
+    }
+
+async def touch_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user:
+        session_last_seen[update.effective_user.id] = time.monotonic()
+
+async def stash_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Диалог простоял SESSION_TTL. Если игрок был посреди игры, запоминаем
+    в его записи только [состояние, номер вопроса], а всё промежуточное забываем.
+    """
+    if update and update.effective_user and stash_progress(update.effective_user.id, context.user_data):
+        save_data()
+    context.user_data.clear()
+
+def stash_progress(tg_id: int, user_data: dict) -> bool:
+    # [состояние, номер вопроса] прерванной игры — в запись игрока
+    state = user_data.get("game")
+    games = resumable_games()
+    user = users.get(tg_to_user.get(tg_id))
+    if user and state in games:
+        user["resume"] = [state, user_data.get(games[state][0], 0)]
+        return True
+    return False
+
+# Внутренности ConversationHandler, на которые опирается end_orphaned_conversations
+CONVERSATION_INTERNALS = ("_conversations", "_update_state")
+
+def check_conversation_internals(handler: ConversationHandler):
+    """
+    Проверка при запуске: после обновления python-telegram-bot внутренние поля
+    могут пропасть, и сборщик зависших диалогов молча перестанет работать.
+    Пусть лучше бот не стартует.
+    """
+    conversations = getattr(handler, "_conversations", None)
+    update_state = getattr(handler, "_update_state", None)
+    if not isinstance(conversations, dict) or not callable(update_state):
+        raise RuntimeError(
+            f"python-telegram-bot {PTB_VERSION}: у ConversationHandler нет "
+            f"{' / '.join(CONVERSATION_INTERNALS)}, без них не закрыть диалоги, "
+            "восстановленные после рестарта. Поставьте версию из requirements.txt "
+            "или поправьте end_orphaned_conversations."
+        )
+
+async def end_orphaned_conversations(app: Application) -> int:
+    """
+    Диалоги без задания-таймаута — восстановленные StorePersistence после
+    рестарта — сами не закончатся. Тех, чей владелец выпал из session_last_seen,
+    закрываем так же, как таймаут: прогресс игры — в resume, состояние — END.
+    Публичного способа сменить состояние у ConversationHandler нет,
+    поэтому здесь — его внутренний словарь (есть ли он, проверяется при запуске).
+    """
+    ended = 0
+    for group in app.handlers.values():
+        for handler in group:
+            if not isinstance(handler, ConversationHandler) or not handler.conversation_timeout:
+                continue
+            for key in list(handler._conversations):
+                user_id = key[-1]
+                if key in handler.timeout_jobs or user_id in session_last_seen:
+                    continue
+                user_data = app.user_data.get(user_id)
+                if user_data is None and isinstance(app.persistence, StorePersistence):
+                    # user_data подгружается лениво — у не вернувшихся она только в sessions
+                    user_data = app.persistence.part()["user"].get(user_id)
+                stash_progress(user_id, user_data or {})
+                handler._update_state(ConversationHandler.END, key)
+                if app.persistence:
+                    await app.persistence.drop_user_data(user_id)
+                ended += 1
+    return ended
+
+async def resume_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Первый текст после простоя: продолжаем прерванную игру или показываем меню.
+    """
+    user, uid = get_user_by_tg(update)
+    resume = user.pop("resume", None) if user else None
+    if resume and resume[0] in resumable_games():
+        state, idx = resume
+        key, send_question = resumable_games()[state]
+        context.user_data["mode"] = user["mode"]
+        context.user_data[key] = idx
+        save_data()
+        await update.message.reply_text("С возвращением! Продолжаем игру с того же задания.")
+        return await send_question(update, context)
+
+    if resume:
+        save_data()
+    return await back_to_menu(update, context)
+
+async def sweep_sessions(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Выгружает user_data/chat_data тех, кто молчит дольше SESSION_TTL.
+    Запас в минуту — чтобы таймаут диалога успел сохранить прогресс игры.
+    """
+    app = context.application
+    cutoff = time.monotonic() - SESSION_TTL - 60
+
+    for user_id, seen in list(session_last_seen.items()):
+        if seen < cutoff:
+            del session_last_seen[user_id]
+    # до выгрузки user_data — из неё берётся прогресс игры
+    if await end_orphaned_conversations(app):
+        save_data()
+    for user_id in list(app.user_data):
+        if user_id not in session_last_seen:
+            app.drop_user_data(user_id)
+    for chat_id in list(app.chat_data):
+        if chat_id not in session_last_seen:
+            app.drop_chat_data(chat_id)
+
+def sessions_stats_text(app: Application) -> str:
+    text = (
+        f"Сессии: активных {len(session_last_seen)}, "
+        f"user_data {len(app.user_data)}, chat_data {len(app.chat_data)}"
+    )
+    if resource:
+        # ru_maxrss в Linux — в килобайтах
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        text += f", пик памяти процесса {peak:.0f} МБ"
+    return text
+
+# =============================
+#   СОХРАНЕНИЕ ДИАЛОГОВ МЕЖДУ РЕСТАРТАМИ
+# =============================
+
+# Из user_data сохраняем только курсор игры и то, что нужно шагам диалога
+PERSISTED_USER_KEYS = (
+    "mode", "game", "reg_uid", "admin_target_uid",
+    "truth_index", "binary_index", "headline_index", "emoji_index",
+)
+
+class StorePersistence(BasePersistence):
+    """
+    Хранит состояния ConversationHandler и курсоры игр в том же файле, что и баллы
+    (раздел "sessions"). PTB отдаёт изменения пачкой раз в PERSIST_INTERVAL,
+    на диск они попадают с ближайшим save_data() или по flush().
+    user_data восстанавливается лениво — при первом апдейте от пользователя.
+    label — метка дополнительного бота: его диалоги хранятся отдельно.
+    """
+
+    def __init__(self, label: str = None):
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=False, chat_data=False, user_data=True, callback_data=False
+            ),
+            update_interval=PERSIST_INTERVAL,
+        )
+        self.dirty = False
+        self.label = label
+
+    def part(self) -> dict:
+        if self.label is None:
+            return sessions
+        return sessions.setdefault("bots", {}).setdefault(self.label, {"conv": {}, "user": {}})
+
+    async def get_conversations(self, name: str):
+        # состояния — это маленькие int, их проще отдать сразу
+        out = {}
+        now = time.monotonic()
+        for key, state in self.part()["conv"].items():
+            out[tuple(int(k) for k in key.split(":"))] = state
+            # таймаута у восстановленного диалога нет — отсчёт простоя с рестарта,
+            # дальше его закроет sweep_sessions
+            session_last_seen.setdefault(int(key.split(":")[-1]), now)
+        return out
+
+    async def update_conversation(self, name: str, key, new_state):
+        str_key = ":".join(str(part) for part in key)
+        conv = self.part()["conv"]
+        if new_state is None:
+            if conv.pop(str_key, None) is not None:
+                self.dirty = True
+        elif conv.get(str_key) != new_state:
+            conv[str_key] = new_state
+            self.dirty = True
+
+    async def get_user_data(self):
+        # ничего не грузим заранее — см. refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        stored = self.part()["user"]
+        if not user_data and user_id in stored:
+            user_data.update(stored[user_id])
+
+    async def update_user_data(self, user_id: int, data: dict):
+        compact = {k: data[k] for k in PERSISTED_USER_KEYS if k in data}
+        stored = self.part()["user"]
+        if compact:
+            if stored.get(user_id) != compact:
+                stored[user_id] = compact
+                self.dirty = True
+        elif stored.pop(user_id, None) is not None:
+            self.dirty = True
+
+    async def drop_user_data(self, user_id: int):
+        if self.part()["user"].pop(user_id, None) is not None:
+            self.dirty = True
+
+    async def flush(self):
+        # заодно — статистика по вопросам, у неё тот же ритм записи
+        flush_question_stats()
+        if self.dirty:
+            self.dirty = False
+            save_data()
+
+    # chat_data, bot_data и callback_data боту не нужны
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+async def flush_sessions(context: ContextTypes.DEFAULT_TYPE):
+    await context.application.persistence.flush()
+
+# =============================
+#   HTTP-ТРАНСПОРТ К BOT API
+# =============================
+
+def http_version() -> str:
+    if not HTTP2:
+        return "1.1"
+    try:
+        import h2  # noqa: F401 — нужен httpx для HTTP/2
+    except ImportError:
+        print("HTTP2=1, но пакет h2 не установлен (pip install httpx[http2]) — работаем по HTTP/1.1")
+        return "1.1"
+    return "2"
+
+class MeteredRequest(BaseRequest):
+    """
+    Обёртка над пулом соединений: считает запросы в полёте, пик, ошибки, время
+    и темп запросов за последнюю минуту.
+    """
+
+    RATE_WINDOW = 60
+
+    def __init__(self, name: str, inner: BaseRequest, pool_size: int):
+        self.name = name
+        self.inner = inner
+        self.pool_size = pool_size
+        self.in_flight = 0
+        self.peak = 0
+        self.total = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.recent = deque()  # время завершения запросов за последние RATE_WINDOW сек
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        started = time.monotonic()
+        try:
+            return await self.inner.do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout,
+                pool_timeout=pool_timeout,
+            )
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self.total += 1
+            now = time.monotonic()
+            self.busy_time += now - started
+            self.recent.append(now)
+            self.trim(now)
+
+    def trim(self, now: float):
+        while self.recent and self.recent[0] < now - self.RATE_WINDOW:
+            self.recent.popleft()
+
+    def rate(self) -> float:
+        # запросов в секунду за последнюю минуту
+        self.trim(time.monotonic())
+        return len(self.recent) / self.RATE_WINDOW
+
+    def stats_text(self) -> str:
+        avg = self.busy_time / self.total * 1000 if self.total else 0.0
+        return (
+            f"— {self.name}: сейчас {self.in_flight}/{self.pool_size}, пик {self.peak}, "
+            f"запросов {self.total}, ошибок {self.errors}, в среднем {avg:.0f} мс"
+        )
+
+class RoutedRequest(BaseRequest):
+    """
+    Запросы с загрузкой файлов идут через пул media, всё остальное — через regular,
+    чтобы загрузки не задерживали текстовые ответы. Отправка по file_id или file://
+    (local mode) файлов не содержит и идёт обычным пулом.
+    """
+
+    def __init__(self, regular: MeteredRequest, media: MeteredRequest):
+        self.regular = regular
+        self.media = media
+
+    @property
+    def read_timeout(self):
+        return self.regular.read_timeout
+
+    async def initialize(self):
+        await self.regular.initialize()
+        await self.media.initialize()
+
+    async def shutdown(self):
+        await self.regular.shutdown()
+        await self.media.shutdown()
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        pool = self.media if request_data is not None and request_data.contains_files else self.regular
+        return await pool.do_request(url, method, request_data=request_data, **timeouts)
+
+def build_requests():
+    """
+    (запросы бота, запрос для getUpdates, все пулы для статистики).
+    """
+    version = http_version()
+    regular = MeteredRequest("ответы", HTTPXRequest(
+        connection_pool_size=HTTP_POOL_SIZE,
+        read_timeout=HTTP_TIMEOUT, write_timeout=HTTP_TIMEOUT, connect_timeout=HTTP_TIMEOUT,
+        http_version=version,
+    ), HTTP_POOL_SIZE)
+    media = MeteredRequest("картинки", HTTPXRequest(
+        connection_pool_size=HTTP_MEDIA_POOL_SIZE,
+        read_timeout=HTTP_MEDIA_TIMEOUT, write_timeout=HTTP_MEDIA_TIMEOUT,
+        media_write_timeout=HTTP_MEDIA_TIMEOUT, connect_timeout=HTTP_TIMEOUT,
+        pool_timeout=HTTP_MEDIA_TIMEOUT,
+        http_version=version,
+    ), HTTP_MEDIA_POOL_SIZE)
+    # long-poll висит до таймаута getUpdates — одного соединения ему хватает
+    polling = MeteredRequest("getUpdates", HTTPXRequest(
+        connection_pool_size=1,
+        read_timeout=HTTP_POLL_TIMEOUT, connect_timeout=HTTP_TIMEOUT,
+        http_version=version,
+    ), 1)
+    return RoutedRequest(regular, media), polling, [regular, media, polling]
+
+def http_stats_text(pools) -> str:
+    return "\n".join(["HTTP-пулы Bot API:"] + [pool.stats_text() for pool in pools])
+
+def bots_stats_text() -> str:
+    """
+    Нагрузка по ботам: запросы к Bot API в секунду за последнюю минуту
+    (у Telegram лимит — около 30 сообщений в секунду на бота) и гости с открытой сессией.
+    """
+    lines = ["Боты:"]
+    load = {}
+    for label, app in bot_apps.items():
+        load[label] = sum(pool.rate() for pool in app.bot_data.get("send_pools", []))
+        lines.append(
+            f"— {label} (@{app.bot.username}): {load[label]:.1f} запр/с "
+            f"({load[label] * MeteredRequest.RATE_WINDOW:.0f} за минуту), "
+            f"гостей с сессией {len(app.user_data)}"
+        )
+    lines.append(f"Новых гостей лучше звать в бота {min(load, key=load.get)}")
+    return "\n".join(lines)
+
+# =============================
+#   АДМИН: ПРОФИЛИРОВАНИЕ
+# =============================
+
+# Сейчас активный профайлер: "cpu", "mem" или None.
+# Пока профилирование выключено, никаких хуков не стоит — накладных расходов нет.
+profile_active = None
+
+def format_cpu_profile(prof: cProfile.Profile, limit: int = 25) -> str:
+    out = io.StringIO()
+    stats = pstats.Stats(prof, stream=out)
+    stats.strip_dirs().sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+def format_mem_snapshot(snapshot: tracemalloc.Snapshot, limit: int = 25) -> str:
+    lines = []
+    for i, stat in enumerate(snapshot.statistics("lineno")[:limit], start=1):
+        frame = stat.traceback[0]
+        lines.append(
+            f"{i}. {os.path.basename(frame.filename)}:{frame.lineno} — "
+            f"{stat.size / 1024:.1f} KiB в {stat.count} блоках"
+        )
+    return "\n".join(lines) or "Новых аллокаций нет."
+
+async def run_profile(bot, chat_id: int, kind: str, seconds: int):
+    global profile_active
+    try:
+        if kind == "cpu":
+            prof = cProfile.Profile()
+            prof.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                prof.disable()
+            summary = format_cpu_profile(prof)
+            with tempfile.NamedTemporaryFile(suffix=".prof", delete=False) as tmp:
+                dump_path = tmp.name
+            prof.dump_stats(dump_path)
+            filename = f"cpu_{int(time.time())}.prof"
+        else:
+            tracemalloc.start(25)
+            try:
+                await asyncio.sleep(seconds)
+                snapshot = tracemalloc.take_snapshot()
+            finally:
+                tracemalloc.stop()
+            summary = format_mem_snapshot(snapshot)
+            with tempfile.NamedTemporaryFile(suffix=".tracemalloc", delete=False) as tmp:
+                dump_path = tmp.name
+            snapshot.dump(dump_path)
+            filename = f"mem_{int(time.time())}.tracemalloc"
+    finally:
+        profile_active = None
+
+    try:
+        # лимит Telegram на сообщение — 4096 символов
+        await bot.send_message(
+            chat_id,
+            f"Профиль {kind} за {seconds} с:\n\n{summary}"[:4000],
+        )
+        with open(dump_path, "rb") as f:
+            await bot.send_document(chat_id, document=f, filename=filename)
+    finally:
+        os.remove(dump_path)
+
+async def admin_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /profile cpu|mem [секунды] — включает cProfile или tracemalloc на N секунд
+    и присылает топ функций/мест аллокаций и файл со статистикой.
+    """
+    global profile_active
+
+    tg_id = update.effective_user.id
+    if tg_id not in ADMIN_IDS:
+        await update.message.reply_text("Эта функция доступна только организаторам.")
+        return
+
+    args = context.args or []
+    kind = args[0].lower() if args else "cpu"
+    if kind not in ("cpu", "mem"):
+        await update.message.reply_text("Использование: /profile cpu|mem [секунды]")
+        return
+
+    seconds = 30
+    if len(args) > 1:
+        if not args[1].isdigit() or int(args[1]) < 1:
+            await update.message.reply_text("Длительность — целое число секунд.")
+            return
+        seconds = min(int(args[1]), PROFILE_MAX_SECONDS)
+
+    if profile_active:
+        await update.message.reply_text(
+            f"Уже идёт профилирование ({profile_active}). Дождитесь результата."
+        )
+        return
+
+    profile_active = kind
+    context.application.create_task(
+        run_profile(context.bot, update.effective_chat.id, kind, seconds)
+    )
+    await update.message.reply_text(
+        f"Профилирование {kind} запущено на {seconds} с. Результат пришлю сюда."
+    )
+
+# =============================
+#   РАЗБОР БЭКЛОГА ПОСЛЕ РЕСТАРТА
+# =============================
+
+def read_only_key(update: Update):
+    """
+    Для запросов «только посмотреть» — их вид (текст кнопки или "inline"), иначе None.
+    """
+    if update.inline_query:
+        return "inline"
+    msg = update.message
+    if msg and msg.text in READ_ONLY_BUTTONS:
+        return msg.text
+    return None
+
+def is_read_only_update(update: Update) -> bool:
+    return read_only_key(update) is not None
+
+def triage_backlog(updates, now: float):
+    """
+    Всё, что меняет состояние (ответы, регистрация, начисления), остаётся по порядку.
+    Из повторов «только посмотреть» остаётся последний на пользователя и кнопку,
+    а слишком старые выбрасываются совсем.
+    Возвращает (оставленные апдейты, сколько свёрнуто, сколько устарело).
+    """
+    latest = {}
+    for i, upd in enumerate(updates):
+        if is_read_only_update(upd):
+            latest[(upd.effective_user.id, read_only_key(upd))] = i
+
+    kept, collapsed, stale = [], 0, 0
+    for i, upd in enumerate(updates):
+        if not is_read_only_update(upd):
+            kept.append(upd)
+        elif latest[(upd.effective_user.id, read_only_key(upd))] != i:
+            collapsed += 1
+        elif upd.message and now - upd.message.date.timestamp() > TRIAGE_MAX_AGE:
+            stale += 1
+        else:
+            kept.append(upd)
+    return kept, collapsed, stale
+
+async def drain_backlog(app: Application):
+    """
+    Забирает все ожидающие апдейты до старта polling, разбирает и обрабатывает их.
+    Подтверждённые здесь апдейты updater повторно уже не получит.
+    """
+    backlog = []
+    offset = None
+    try:
+        await app.bot.delete_webhook()
+        while True:
+            batch = await app.bot.get_updates(offset=offset, timeout=0, limit=100)
+            if not batch:
+                break
+            backlog.extend(batch)
+            offset = batch[-1].update_id + 1
+    except TelegramError as e:
+        print(f"Разбор бэклога пропущен: {e}")
+        return
+
+    if not backlog:
+        return
+
+    kept, collapsed, stale = triage_backlog(backlog, time.time())
+    # бэклог разбирается до app.start(); без запущенной JobQueue
+    # ConversationHandler не ставит таймауты открытым здесь диалогам
+    if app.job_queue:
+        await app.job_queue.start()
+    app.bot_data["draining_backlog"] = True
+    try:
+        for upd in kept:
+            await app.process_update(upd)
+    finally:
+        app.bot_data["draining_backlog"] = False
+    print(
+        f"Бэклог: получено {len(backlog)}, обработано {len(kept)}, "
+        f"свёрнуто повторов {collapsed}, устаревших {stale}"
+    )
+
+# =============================
+#   ФИЛЬТР ЧАСТЫХ НАЖАТИЙ
+# =============================
+
+class AdmissionFilter:
+    """
+    Стоит перед всеми хендлерами. Запросы «посмотреть баллы/таблицу»:
+    повтор в пределах DUP_WINDOW отбрасывается, частота ограничена (token bucket),
+    на приторможенные — ответ из кэша. Ответы в играх: отбрасывается только
+    повтор того же текста в пределах DUP_WINDOW — двойное нажатие кнопки иначе
+    засчиталось бы ответом на следующий вопрос. Регистрация и начисления
+    проходят всегда, как и бэклог при старте — его время не настоящее,
+    а разбирает его drain_backlog.
+    Состояние хранится только для последних ADMISSION_MAX_USERS пользователей (LRU).
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        # tg_id -> [последний текст, его время, токены, время пополнения]
+        self.states = OrderedDict()
+        self.dropped_dups = 0
+        self.throttled = 0
+
+    def admit(self, tg_id: int, text: str, throttle: bool = True) -> str:
+        """
+        Возвращает "ok", "dup" или "throttled". throttle=False — только проверка повтора.
+        """
+        now = self.clock()
+        state = self.states.get(tg_id)
+        if state is None:
+            state = self.states[tg_id] = [None, 0.0, float(USER_BURST), now]
+            if len(self.states) > ADMISSION_MAX_USERS:
+                self.states.popitem(last=False)
+        else:
+            self.states.move_to_end(tg_id)
+
+        if text is not None and text == state[0] and now - state[1] < DUP_WINDOW:
+            return "dup"
+
+        if throttle and not is_admin_id(tg_id):
+            state[2] = min(float(USER_BURST), state[2] + (now - state[3]) * USER_RATE)
+            state[3] = now
+            if state[2] < 1:
+                return "throttled"
+            state[2] -= 1
+
+        state[0] = text
+        state[1] = now
+        return "ok"
+
+    async def check(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None or context.bot_data.get("draining_backlog"):
+            return
+        read_only = is_read_only_update(update)
+        # открыт вопрос игры — user_data["game"] ставят send_*_question
+        answering = bool(update.message and context.user_data and context.user_data.get("game"))
+        if not read_only and not answering:
+            return
+        text = update.message.text if update.message else None
+
+        verdict = self.admit(user.id, text, throttle=read_only)
+        if verdict == "ok":
+            return
+        if verdict == "dup":
+            self.dropped_dups += 1
+        else:
+            self.throttled += 1
+            await answer_from_cache(update)
+        raise ApplicationHandlerStop
+
+    def stats_text(self) -> str:
+        return (
+            f"Фильтр нажатий: отброшено повторов {self.dropped_dups}, "
+            f"приторможено {self.throttled}, пользователей в памяти {len(self.states)}"
+        )
+
+async def answer_from_cache(update: Update):
+    user, uid = get_user_by_tg(update)
+    if not user or not update.message:
+        return
+    text = update.message.text
+    if text in POINTS_BUTTONS:
+        await update.message.reply_text(f"Ваши баллы: {user['points']}")
+    elif text in LEADERBOARD_BUTTONS and user["mode"] in last_leaderboards:
+        await update.message.reply_text(last_leaderboards[user["mode"]])
+
+# =============================
+#   ПРИОРИТЕТЫ ВХОДЯЩИХ АПДЕЙТОВ
+# =============================
+
+# Классы апдейтов: волонтёры/админы, ответы в играх и регистрация, просмотр таблиц
+UPDATE_CLASSES = ("admin", "game", "view")
+
+def parse_class_map(raw: str) -> dict:
+    # "admin:6,game:3,view:1" -> {"admin": 6, "game": 3, "view": 1}
+    out = {}
+    for part in raw.split(","):
+        name, _, value = part.partition(":")
+        if name.strip() in UPDATE_CLASSES and value.strip().isdigit():
+            out[name.strip()] = max(1, int(value))
+    return out
+
+def classify_update(update: object) -> str:
+    if isinstance(update, Update):
+        user = update.effective_user
+        if user and is_admin_id(user.id):
+            return "admin"
+        if is_read_only_update(update):
+            return "view"
+    return "game"
+
+class PriorityUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает апдейты параллельно, но со взвешенными приоритетами по классам
+    и отдельным лимитом одновременных апдейтов на класс.
+    Апдейты одного пользователя всё равно идут строго по очереди —
+    ConversationHandler на это рассчитывает.
+    """
+
+    def __init__(self, slots: int, weights: dict, limits: dict, backlog: int = 4096):
+        # backlog — сколько апдейтов может ждать в очередях классов
+        super().__init__(backlog)
+        self.slots = slots
+        self.weights = {c: weights.get(c, 1) for c in UPDATE_CLASSES}
+        self.limits = {c: min(limits.get(c, slots), slots) for c in UPDATE_CLASSES}
+        self.busy = 0
+        self.running = {c: 0 for c in UPDATE_CLASSES}
+        self.waiting = {c: deque() for c in UPDATE_CLASSES}
+        self.credit = {c: 0 for c in UPDATE_CLASSES}
+        self.user_locks = {}
+        # задержка в очереди по классам: [кол-во, сумма, максимум]
+        self.delays = {c: [0, 0.0, 0.0] for c in UPDATE_CLASSES}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _can_run(self, cls: str) -> bool:
+        return self.busy < self.slots and self.running[cls] < self.limits[cls]
+
+    def _grant(self, cls: str):
+        self.busy += 1
+        self.running[cls] += 1
+
+    def _dispatch(self):
+        # smooth weighted round-robin среди классов, у которых есть ожидающие и свободный лимит
+        while self.busy < self.slots:
+            eligible = [
+                c for c in UPDATE_CLASSES
+                if self.waiting[c] and self.running[c] < self.limits[c]
+            ]
+            if not eligible:
+                return
+            total = 0
+            for c in eligible:
+                self.credit[c] += self.weights[c]
+                total += self.weights[c]
+            cls = max(eligible, key=lambda c: self.credit[c])
+            self.credit[cls] -= total
+
+            fut = self.waiting[cls].popleft()
+            if fut.done():
+                continue
+            self._grant(cls)
+            fut.set_result(None)
+
+    async def _acquire(self, cls: str):
+        if not self.waiting[cls] and self._can_run(cls):
+            self._grant(cls)
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self.waiting[cls].append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # слот уже выдан — возвращаем его
+                self._release(cls)
+            raise
+
+    def _release(self, cls: str):
+        self.busy -= 1
+        self.running[cls] -= 1
+        self._dispatch()
+
+    async def do_process_update(self, update: object, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        key = user.id if user else None
+
+        entry = self.user_locks.get(key)
+        if entry is None:
+            entry = self.user_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                cls = classify_update(update)
+                queued_at = time.monotonic()
+                await self._acquire(cls)
+                waited = time.monotonic() - queued_at
+                stat = self.delays[cls]
+                stat[0] += 1
+                stat[1] += waited
+                stat[2] = max(stat[2], waited)
+                try:
+                    await coroutine
+                finally:
+                    self._release(cls)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self.user_locks.pop(key, None)
+
+    def stats_text(self) -> str:
+        lines = [f"Очередь апдейтов (слотов {self.busy}/{self.slots}):"]
+        for c in UPDATE_CLASSES:
+            count, total, worst = self.delays[c]
+            avg = total / count * 1000 if count else 0.0
+            lines.append(
+                f"— {c}: в работе {self.running[c]}/{self.limits[c]}, ждут {len(self.waiting[c])}, "
+                f"обработано {count}, задержка ср. {avg:.0f} мс, макс. {worst * 1000:.0f} мс"
+            )
+        return "\n".join(lines)
+
+# =============================
+#       АДМИН: СТАТИСТИКА
+# =============================
+
+def stats_sections(app: Application):
+    # каждая подсистема добавляет сюда свой блок для /stats
+    sections = []
+    if isinstance(app.update_processor, PriorityUpdateProcessor):
+        sections.append(app.update_processor.stats_text())
+    if "admission" in app.bot_data:
+        sections.append(app.bot_data["admission"].stats_text())
+    sections.append(sessions_stats_text(app))
+    if app.bot_data.get("http_pools"):
+        sections.append(http_stats_text(app.bot_data["http_pools"]))
+    if len(bot_apps) > 1:
+        sections.append(bots_stats_text())
+    if EVENTS_DIR:
+        sections.append(events_stats_text())
+    return sections
+
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tg_id = update.effective_user.id
+    if tg_id not in ADMIN_IDS:
+        await update.message.reply_text("Эта функция доступна только организаторам.")
+        return
+
+    sections = stats_sections(context.application)
+    text = "\n\n".join(sections) if sections else "Статистики пока нет."
+    await update.message.reply_text(text[:4000])
+
+# =============================
+#   ЗАПИСЬ И РЕПЛЕЙ АПДЕЙТОВ
+# =============================
+
+# Поля пользователя/чата, которые в записи заменяются хешами
+PII_STR_FIELDS = {"first_name", "last_name", "username", "title", "phone_number", "bio"}
+# Объекты, у которых "id" — это Telegram ID человека или чата
+PII_ID_PARENTS = {"from", "chat", "user", "sender_chat", "forward_from", "contact"}
+
+def pseudo_id(tg_id: int) -> int:
+    """
+    Стабильный псевдо-ID: одинаковый для одного и того же tg_id при той же соли.
+    """
+    digest = hmac.new(RECORD_SALT.encode(), str(tg_id).encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:6], "big") or 1
+
+def pseudo_str(value: str) -> str:
+    digest = hmac.new(RECORD_SALT.encode(), value.encode(), hashlib.sha256).hexdigest()
+    return "h" + digest[:10]
+
+PSEUDO_NAME_LETTERS = "абвгдежзиклмнопр"
+
+def pseudo_name(text: str) -> str:
+    """
+    Имя, введённое при регистрации, — в хеш, который проходит validate_name
+    так же, как исходный текст: каждое слово — своё «слово» из букв.
+    Невалидный ввод остаётся невалидным (pseudo_str — одно слово с цифрами).
+    """
+    if not validate_name(text):
+        return pseudo_str(text)
+    return " ".join(
+        "".join(PSEUDO_NAME_LETTERS[int(c, 16)] for c in pseudo_str(word)[1:]).capitalize()
+        for word in text.split()
+    )
+
+def anonymize(obj, parent: str = ""):
+    if isinstance(obj, dict):
+        out = {}
+        for k, v in obj.items():
+            if k in PII_STR_FIELDS and isinstance(v, str):
+                out[k] = pseudo_str(v)
+            elif k in ("id", "user_id") and parent in PII_ID_PARENTS and isinstance(v, int):
+                out[k] = pseudo_id(v)
+            else:
+                out[k] = anonymize(v, k)
+        return out
+    if isinstance(obj, list):
+        return [anonymize(v, parent) for v in obj]
+    return obj
+
+class UpdateRecorder:
+    """
+    Пишет каждый апдейт одной строкой JSON в gzip-лог: {"t": время, "u": апдейт}.
+    """
+
+    def __init__(self, path: str, flush_every: int = 50):
+        if len(RECORD_SALT) < RECORD_SALT_MIN_LENGTH:
+            raise RuntimeError(
+                f"Для записи апдейтов нужна RECORD_SALT — случайная строка не короче "
+                f"{RECORD_SALT_MIN_LENGTH} символов, например: "
+                "python -c 'import secrets; print(secrets.token_hex(16))'"
+            )
+        self.path = path
+        self.flush_every = flush_every
+        self.count = 0
+        self.file = gzip.open(path, "at", encoding="utf-8")
+
+    async def record(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        data = anonymize(update.to_dict())
+        msg = data.get("message")
+        # имя и фамилия, набранные при регистрации, — тоже персональные данные
+        awaiting_name = context is not None and (context.user_data or {}).get("awaiting_name")
+        if awaiting_name and msg and "text" in msg and not msg["text"].startswith("/"):
+            msg["text"] = pseudo_name(msg["text"])
+        line = json.dumps(
+            {"t": round(time.time(), 3), "u": data},
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        self.file.write(line + "\n")
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def read_recording(path: str):
+    """
+    Записи по порядку. Лог процесса, убитого без close(), обрывается
+    недописанным gzip-блоком — читаем всё, что успело записаться.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # строка оборвалась на середине
+                    print(f"Запись {path} обрывается на неполной строке")
+                    return
+        except EOFError:
+            print(f"Запись {path} оборвана (процесс не закрыл лог), дальше не читаем")
+
+class FakeBotRequest(BaseRequest):
+    """
+    Подставной транспорт: отвечает на любой вызов Bot API успехом,
+    ничего не отправляя в сеть. Считает вызовы по методам.
+    Годится и как замена локального сервера Bot API: проверяет file://-ссылки.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        params = request_data.parameters if request_data else {}
+
+        # как локальный telegram-bot-api: file://-ссылка должна указывать на существующий файл
+        for value in params.values():
+            if isinstance(value, str) and value.startswith("file://"):
+                if not os.path.isfile(urllib.parse.unquote(urllib.parse.urlparse(value).path)):
+                    body = {"ok": False, "error_code": 400, "description": f"Bad Request: file not found: {value}"}
+                    return 400, json.dumps(body).encode()
+                self.calls["file://"] = self.calls.get("file://", 0) + 1
+
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "ReplayBot", "username": "replay_bot"}
+        elif api_method.startswith("send") or api_method.startswith("edit"):
+            self.message_id += 1
+            result = {
+                "message_id": params.get("message_id", self.message_id),
+                "date": int(time.time()),
+                "chat": {"id": params.get("chat_id", 0), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+def scores_snapshot(users_map: dict = None, tg_map: dict = None):
+    """
+    Баллы по игрокам. Ключ — Telegram ID (у гостей из списка, ещё не пришедших
+    в бота, — имя), а не uid: у воркеров ID раздаются в другом порядке.
+    """
+    users_map = users if users_map is None else users_map
+    tg_map = tg_to_user if tg_map is None else tg_map
+    uid_tg = {uid: tg_id for tg_id, uid in tg_map.items()}
+    return {
+        uid_tg.get(int(uid), info.get("name")): info.get("points", 0)
+        for uid, info in users_map.items()
+    }
+
+async def replay_updates(path: str, speed: str = "max", expected_file: str = None, workers: int = 1):
+    """
+    Прогоняет записанный вечер через те же хендлеры с подставным ботом.
+    speed: "1", "10" и т.п. — во сколько раз быстрее реального времени, "max" — без пауз.
+    workers > 1 — через воркеры с общей базой, как в режиме вебхука.
+    """
+    global DATA_FILE, users, tg_to_user, next_uid, ADMIN_IDS
+
+    if not RECORD_SALT:
+        # без соли записи не сопоставить ни ID админов, ни эталон
+        raise RuntimeError("Для реплея нужна RECORD_SALT, с которой делалась запись.")
+
+    # отдельное чистое состояние, боевой файл не трогаем
+    fd, DATA_FILE = tempfile.mkstemp(prefix="replay_", suffix=".json")
+    os.close(fd)
+    os.remove(DATA_FILE)
+    users, tg_to_user, next_uid = {}, {}, 1
+    recount_teams()
+    # админы в записи тоже под псевдо-ID
+    ADMIN_IDS = ADMIN_IDS | {pseudo_id(a) for a in ADMIN_IDS}
+    factor = None if speed == "max" else float(speed)
+
+    if workers > 1:
+        count, elapsed, calls, final_users, final_tg = await asyncio.to_thread(
+            replay_workers, path, factor, workers
+        )
+        scores = scores_snapshot(final_users, final_tg)
+    else:
+        # фильтр нажатий живёт по записанному времени, а не по реальному
+        replay_clock = [0.0]
+        request = FakeBotRequest()
+        app = build_application("0:replay", request=request, clock=lambda: replay_clock[0])
+
+        count = 0
+        await app.initialize()
+        try:
+            started = time.monotonic()
+            first_t = None
+            for rec in read_recording(path):
+                if factor:
+                    if first_t is None:
+                        first_t = rec["t"]
+                    delay = (rec["t"] - first_t) / factor - (time.monotonic() - started)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                replay_clock[0] = rec["t"]
+                await app.process_update(Update.de_json(rec["u"], app.bot))
+                count += 1
+            elapsed = time.monotonic() - started
+        finally:
+            await app.shutdown()
+            close_audit()
+            audit_path = os.path.splitext(DATA_FILE)[0] + "_audit.sqlite"
+            for path in state_files() + [audit_path, audit_path + "-wal", audit_path + "-shm"]:
+                if os.path.exists(path):
+                    os.remove(path)
+        calls = request.calls
+        scores = scores_snapshot()
+
+    print(f"Апдейтов: {count}, время: {elapsed:.2f} с, {count / max(elapsed, 1e-9):.0f} апд/с")
+    print("Вызовы Bot API:", ", ".join(f"{k}={v}" for k, v in sorted(calls.items())))
+    print(f"Игроков: {len(scores)}, сумма баллов: {sum(scores.values())}")
+
+    if expected_file:
+        # эталон — файл данных того вечера: снимок, его копия или старый JSON
+        with open(expected_file, "rb") as f:
+            data = decode_state_file(expected_file, f.read())
+        # в эталоне настоящие Telegram ID, а в записи — псевдо-ID
+        expected = scores_snapshot(
+            data["users"], {pseudo_id(int(k)): v for k, v in data["tg_to_user"].items()}
+        )
+        diff = {
+            key: (expected.get(key), scores.get(key))
+            for key in expected.keys() | scores.keys()
+            if expected.get(key) != scores.get(key)
+        }
+        if diff:
+            print(f"Баллы НЕ совпали у {len(diff)} игроков:")
+            for key, (exp, got) in sorted(diff.items(), key=str)[:20]:
+                print(f"  {key}: ожидалось {exp}, получилось {got}")
+            return False
+        print("Баллы совпали с эталоном.")
+    return True
+
+# =============================
+#   РЕЖИМ ВОРКЕРОВ ЗА ВЕБХУКОМ
+# =============================
+
+def user_row_data(user: dict) -> str:
+    # баллы хранятся отдельной колонкой — их меняет только points = points + ?
+    return json.dumps({k: v for k, v in user.items() if k != "points"}, ensure_ascii=False)
+
+class SharedStore:
+    """
+    Общее состояние воркеров в SQLite (WAL): игроки, баллы, ID и QR-коды.
+    ID выдаются счётчиком внутри транзакции, баллы меняются атомарным
+    points = points + ?, повторный QR отсекает первичный ключ.
+    Каждая запись получает номер ревизии; воркер перед апдейтом дочитывает
+    строки новее уже виденной — так у него всегда свежие таблицы.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS users (
+            uid INTEGER PRIMARY KEY,
+            tg_id INTEGER UNIQUE,
+            points INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            rev INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS users_rev ON users (rev);
+        CREATE TABLE IF NOT EXISTS qr (uid INTEGER, code INTEGER, PRIMARY KEY (uid, code));
+        CREATE TABLE IF NOT EXISTS worker_state (worker INTEGER PRIMARY KEY, data TEXT NOT NULL);
+        INSERT OR IGNORE INTO meta VALUES ('next_uid', 1), ('rev', 0);
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        self.audit = AuditLog(self.db)
+        self.rev = 0
+        self.synced = {}  # uid -> data, как строка лежит в базе
+        self.worker_blob = None
+
+    @contextmanager
+    def transaction(self):
+        """
+        BEGIN IMMEDIATE — пишущие транзакции идут строго по очереди,
+        поэтому ревизии растут в порядке коммитов. Отдаёт номер новой ревизии.
+        """
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.execute("UPDATE meta SET value = value + 1 WHERE key = 'rev'")
+            rev = self.db.execute("SELECT value FROM meta WHERE key = 'rev'").fetchone()[0]
+            yield rev
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def is_registered(self, tg_id: int) -> bool:
+        return self.db.execute("SELECT 1 FROM users WHERE tg_id = ?", (tg_id,)).fetchone() is not None
+
+    def is_empty(self) -> bool:
+        return self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+
+    def allocate_uids(self, count: int) -> int:
+        with self.transaction():
+            self.db.execute("UPDATE meta SET value = value + ? WHERE key = 'next_uid'", (count,))
+            return self.db.execute("SELECT value FROM meta WHERE key = 'next_uid'").fetchone()[0] - count
+
+    def add_points(self, uid, delta: int, entry: tuple):
+        """
+        Новое значение баллов; None — игрока ещё нет в базе (запишется с ближайшим push).
+        entry — запись для журнала изменений, см. AuditLog.append.
+        """
+        with self.transaction() as rev:
+            self.audit.append(*entry)
+            cur = self.db.execute(
+                "UPDATE users SET points = points + ?, rev = ? WHERE uid = ?", (delta, rev, uid)
+            )
+            if not cur.rowcount:
+                return None
+            return self.db.execute("SELECT points FROM users WHERE uid = ?", (uid,)).fetchone()[0]
+
+    def redeem_qr(self, uid, code: int) -> bool:
+        cur = self.db.execute("INSERT OR IGNORE INTO qr VALUES (?, ?)", (uid, code))
+        return cur.rowcount == 1
+
+    def qr_codes(self) -> set:
+        return {(uid, code) for uid, code in self.db.execute("SELECT uid, code FROM qr")}
+
+    def worker_state(self) -> dict:
+        row = self.db.execute("SELECT data FROM worker_state WHERE worker = ?", (worker_index,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def push(self):
+        """
+        Записывает изменившихся игроков и состояние этого воркера одной транзакцией.
+        Баллы существующих строк не трогает — только add_points.
+        """
+        changed = [(uid, user_row_data(user)) for uid, user in users.items()]
+        changed = [(uid, data) for uid, data in changed if self.synced.get(uid) != data]
+        blob = json.dumps({"live_boards": live_boards, "sessions": sessions}, ensure_ascii=False)
+        if not changed and blob == self.worker_blob:
+            return
+        uid_tg = {uid: tg_id for tg_id, uid in tg_to_user.items()} if changed else {}
+        with self.transaction() as rev:
+            for uid, data in changed:
+                self.db.execute(
+                    "INSERT INTO users (uid, tg_id, points, data, rev) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (uid) DO UPDATE SET "
+                    "tg_id = excluded.tg_id, data = excluded.data, rev = excluded.rev",
+                    (uid, uid_tg.get(uid), int(users[uid].get("points", 0)), data, rev),
+                )
+            if blob != self.worker_blob:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO worker_state VALUES (?, ?)", (worker_index, blob)
+                )
+        for uid, data in changed:
+            self.synced[uid] = data
+        self.worker_blob = blob
+
+    def pull(self):
+        """
+        Дочитывает игроков, изменённых с прошлого раза (в том числе другими воркерами).
+        """
+        rows = self.db.execute(
+            "SELECT uid, tg_id, points, data, rev FROM users WHERE rev > ? ORDER BY rev",
+            (self.rev,),
+        ).fetchall()
+        if not rows:
+            return
+        prereg_touched = False
+        for uid, tg_id, points, data, rev in rows:
+            self.rev = rev
+            user = json.loads(data)
+            if uid in users:
+                # словарь обновляем на месте: параллельный хендлер мог уже взять на него ссылку
+                local = users[uid]
+                team_detach(uid)
+                prereg_touched |= bool(local.get("prereg"))
+                # если свои правки ещё не записаны — из базы берём только баллы
+                if user_row_data(local) == self.synced.get(uid):
+                    local.clear()
+                    local.update(user)
+                user = local
+            user["points"] = points
+            users[uid] = user
+            team_attach(uid)
+            prereg_touched |= bool(user.get("prereg"))
+            if tg_id is not None:
+                tg_to_user[tg_id] = uid
+            self.synced[uid] = data
+        if prereg_touched:
+            rebuild_prereg_index()
+        mark_scores_changed()
+
+    def import_state(self, workers: int):
+        """
+        Первый запуск воркеров: переносит в базу то, что уже загружено из DATA_FILE.
+        """
+        uid_tg = {uid: tg_id for tg_id, uid in tg_to_user.items()}
+        with self.transaction() as rev:
+            for uid, user in users.items():
+                self.db.execute(
+                    "INSERT INTO users VALUES (?, ?, ?, ?, ?)",
+                    (uid, uid_tg.get(uid), int(user.get("points", 0)), user_row_data(user), rev),
+                )
+            self.db.execute("UPDATE meta SET value = ? WHERE key = 'next_uid'", (next_uid,))
+            self.db.executemany("INSERT OR IGNORE INTO qr VALUES (?, ?)", sorted(qr_redeemed))
+            state = {"live_boards": live_boards, "sessions": sessions}
+            self.db.execute(
+                "INSERT OR REPLACE INTO worker_state VALUES (?, ?)", (-1, json.dumps(state))
+            )
+        self.reshard(workers)
+
+    def reshard(self, workers: int):
+        """
+        Раскладывает диалоги и «живые» таблицы по воркерам заново — на случай,
+        если воркеров стало больше или меньше, чем в прошлый запуск.
+        """
+        parts = [
+            {"live_boards": {"online": {}, "offline": {}}, "sessions": {"conv": {}, "user": {}}}
+            for _ in range(workers)
+        ]
+        for (data,) in self.db.execute("SELECT data FROM worker_state").fetchall():
+            state = json.loads(data)
+            for mode, boards in state.get("live_boards", {}).items():
+                for chat_id, msg_id in boards.items():
+                    parts[int(chat_id) % workers]["live_boards"].setdefault(mode, {})[chat_id] = msg_id
+            for key, conv_state in state.get("sessions", {}).get("conv", {}).items():
+                parts[int(key.split(":")[0]) % workers]["sessions"]["conv"][key] = conv_state
+            # диалоги с ботом личные: chat id совпадает с user id
+            for tg_id, data in state.get("sessions", {}).get("user", {}).items():
+                parts[int(tg_id) % workers]["sessions"]["user"][tg_id] = data
+        with self.transaction():
+            self.db.execute("DELETE FROM worker_state")
+            for index, part in enumerate(parts):
+                self.db.execute(
+                    "INSERT INTO worker_state VALUES (?, ?)", (index, json.dumps(part, ensure_ascii=False))
+                )
+
+    def snapshot(self):
+        """
+        (users, tg_to_user) целиком из базы — для проверки реплея.
+        """
+        all_users, all_tg = {}, {}
+        for uid, tg_id, points, data in self.db.execute("SELECT uid, tg_id, points, data FROM users"):
+            all_users[uid] = dict(json.loads(data), points=points)
+            if tg_id is not None:
+                all_tg[tg_id] = uid
+        return all_users, all_tg
+
+    def close(self):
+        self.db.close()
+
+async def sync_shared_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    store.pull()
+
+async def pull_shared_state(context: ContextTypes.DEFAULT_TYPE):
+    # таблицы и табло обновляются и без входящих апдейтов
+    store.pull()
+
+def init_shared_store(path: str, workers: int):
+    """
+    Схема, перенос данных из DATA_FILE при первом запуске и раскладка по воркерам —
+    до старта воркеров, в главном процессе.
+    """
+    shared = SharedStore(path)
+    if shared.is_empty() and any(os.path.exists(p) for p in state_files()):
+        load_data()
+        shared.import_state(workers)
+        print(f"Данные перенесены в {path}: игроков {len(users)}")
+    else:
+        shared.reshard(workers)
+    shared.close()
+
+def update_sender(data: dict):
+    """
+    (chat id, user id) сырого апдейта; для инлайн-запросов chat id — это отправитель.
+    """
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get("from") or {}
+        chat = value.get("chat") or (value.get("message") or {}).get("chat") or user
+        return chat.get("id"), user.get("id")
+    return None, None
+
+def shard_of(data: dict, workers: int) -> int:
+    # все апдейты одного чата — в один воркер: там его диалог и порядок сообщений
+    chat_id, _ = update_sender(data)
+    return chat_id % workers if chat_id is not None else 0
+
+def schedule_jobs(app: Application, scoreboard: bool = True, backups: bool = True):
+    app.job_queue.run_repeating(
+        refresh_live_boards, interval=LIVE_BOARD_INTERVAL, first=LIVE_BOARD_INTERVAL
+    )
+
+    app.job_queue.run_repeating(flush_sessions, interval=PERSIST_INTERVAL, first=PERSIST_INTERVAL)
+
+    if SESSION_TTL:
+        app.job_queue.run_repeating(
+            sweep_sessions, interval=SESSION_SWEEP_INTERVAL, first=SESSION_SWEEP_INTERVAL
+        )
+
+    if store is not None:
+        app.job_queue.run_repeating(pull_shared_state, interval=1, first=1)
+
+    if backups and BACKUP_INTERVAL:
+        app.job_queue.run_repeating(backup_job, interval=BACKUP_INTERVAL, first=BACKUP_INTERVAL)
+
+    if scoreboard and SCOREBOARD_PORT:
+        app.job_queue.run_repeating(publish_scoreboard, interval=1, first=0)
+        start_scoreboard_server(SCOREBOARD_HOST, SCOREBOARD_PORT)
+
+def open_worker_store(index: int, path: str):
+    global store, worker_index
+    worker_index = index
+    store = SharedStore(path)
+    load_data()
+
+async def serve_worker(app: Application, updates_queue):
+    loop = asyncio.get_running_loop()
+    await app.initialize()
+    await app.start()
+    try:
+        while True:
+            item = await loop.run_in_executor(None, updates_queue.get)
+            if item is None:
+                break
+            await app.update_queue.put(Update.de_json(item[1], app.bot))
+        while not app.update_queue.empty() or app.update_processor.current_concurrent_updates:
+            await asyncio.sleep(0.05)
+    finally:
+        await app.stop()
+        await app.shutdown()
+
+def worker_main(index: int, updates_queue):
+    open_worker_store(index, STORE_DB)
+    app = build_application(TOKEN, persistence=StorePersistence())
+    # табло одно на всех — его держит нулевой воркер
+    schedule_jobs(app, scoreboard=index == 0, backups=index == 0)
+    print(f"Воркер {index} запущен, игроков в базе: {len(users)}")
+    try:
+        asyncio.run(serve_worker(app, updates_queue))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        save_data()
+        store.close()
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Принимает апдейты от Telegram и раскладывает их по очередям воркеров.
+    Отвечает сразу — обработка идёт в воркерах.
+    """
+
+    queues = []
+
+    def do_POST(self):
+        if WEBHOOK_SECRET and not hmac.compare_digest(
+            self.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET
+        ):
+            self.send_error(403)
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            data = json.loads(body)
+        except ValueError:
+            self.send_error(400)
+            return
+        self.queues[shard_of(data, len(self.queues))].put((time.time(), data))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+async def register_webhook():
+    kwargs = {"base_url": f"{BOT_API_URL}/bot"} if BOT_API_URL else {}
+    async with Bot(TOKEN, **kwargs) as bot:
+        await bot.set_webhook(
+            WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None, allowed_updates=Update.ALL_TYPES
+        )
+
+def run_workers(count: int):
+    if not WEBHOOK_URL:
+        raise RuntimeError("Для WORKERS > 1 нужен WEBHOOK_URL.")
+    init_shared_store(STORE_DB, count)
+
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(count)]
+    procs = [ctx.Process(target=worker_main, args=(i, q), daemon=True) for i, q in enumerate(queues)]
+    for proc in procs:
+        proc.start()
+
+    asyncio.run(register_webhook())
+    WebhookHandler.queues = queues
+    server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), WebhookHandler)
+    server.daemon_threads = True
+    print(f"Вебхук: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}, воркеров: {count}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for q in queues:
+            q.put(None)
+        for proc in procs:
+            proc.join(timeout=30)
+
+def replay_worker_main(index: int, updates_queue, done, results, path: str, admin_ids):
+    global ADMIN_IDS
+    ADMIN_IDS = admin_ids
+    open_worker_store(index, path)
+    results.put(asyncio.run(replay_worker(updates_queue, done)))
+    store.close()
+
+async def replay_worker(updates_queue, done):
+    loop = asyncio.get_running_loop()
+    replay_clock = [0.0]
+    request = FakeBotRequest()
+    app = build_application("0:replay", request=request, clock=lambda: replay_clock[0])
+    await app.initialize()
+    try:
+        done.value = -1  # готов принимать апдейты
+        while True:
+            item = await loop.run_in_executor(None, updates_queue.get)
+            if item is None:
+                break
+            replay_clock[0] = item[0]
+            await app.process_update(Update.de_json(item[1], app.bot))
+            with done.get_lock():
+                done.value += 1
+    finally:
+        await app.shutdown()
+    save_data()
+    return request.calls
+
+def replay_workers(path: str, factor, workers: int):
+    """
+    Реплей через воркеры: апдейты шардируются по чатам, как за вебхуком.
+    Апдейты админов и ещё не зарегистрированных гостей отправляются только после
+    того, как обработано всё, что было до них: так ID раздаются в записанном порядке
+    и админ начисляет баллы тем же игрокам. Остальное идёт параллельно.
+    Возвращает (апдейтов, секунд, вызовы Bot API, users, tg_to_user).
+    """
+    fd, db_path = tempfile.mkstemp(prefix="replay_", suffix=".sqlite")
+    os.close(fd)
+    os.remove(db_path)
+    init_shared_store(db_path, workers)
+
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(workers)]
+    done = [ctx.Value("i", 0) for _ in range(workers)]
+    results = ctx.Queue()
+    procs = [
+        ctx.Process(target=replay_worker_main, args=(i, queues[i], done[i], results, db_path, ADMIN_IDS))
+        for i in range(workers)
+    ]
+    for proc in procs:
+        proc.start()
+    shared = SharedStore(db_path)
+    registered = set()
+
+    sent = [0] * workers
+    count = 0
+    first_t = None
+    try:
+        # время считаем с момента, когда все воркеры поднялись
+        while any(d.value != -1 for d in done):
+            time.sleep(0.01)
+        for d in done:
+            d.value = 0
+        started = time.monotonic()
+        for rec in read_recording(path):
+            if factor:
+                if first_t is None:
+                    first_t = rec["t"]
+                delay = (rec["t"] - first_t) / factor - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            sender = update_sender(rec["u"])[1]
+            if sender not in registered and shared.is_registered(sender):
+                registered.add(sender)
+            if sender in ADMIN_IDS or sender not in registered:
+                while any(d.value < n for d, n in zip(done, sent)):
+                    time.sleep(0.001)
+            shard = shard_of(rec["u"], workers)
+            queues[shard].put((rec["t"], rec["u"]))
+            sent[shard] += 1
+            count += 1
+        for q in queues:
+            q.put(None)
+        calls = {}
+        for _ in range(workers):
+            for method, n in results.get().items():
+                calls[method] = calls.get(method, 0) + n
+        elapsed = time.monotonic() - started
+        for proc in procs:
+            proc.join()
+        all_users, all_tg = shared.snapshot()
+    finally:
+        shared.close()
+        for proc in procs:
+            if proc.is_alive():
+                proc.kill()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+    return count, elapsed, calls, all_users, all_tg
+
+# =============================
+#   НЕСКОЛЬКО СОБЫТИЙ В ОДНОМ ПРОЦЕССЕ
+# =============================
+
+EVENT_MAIN = "main"
+EVENT_LINK_RE = re.compile(r"^/start ev-([a-z0-9_]{1,40})$")
+
+# Какие списки вопросов можно заменить в event.json: ключ -> (глобальная переменная, есть ли картинка)
+QUESTION_BANKS = {
+    "truth": ("TRUTH_GAME_QUESTIONS", True),
+    "binary": ("BINARY_GAME_QUESTIONS", True),
+    "headline": ("HEADLINE_GAME_QUESTIONS", True),
+    "emoji": ("EMOJI_GAME_QUESTIONS", False),
+}
+
+# event_members: {tg_id: имя события} — гости не основного события (EVENTS_DIR/members.json)
+event_members = {}
+# loaded_events: {имя события: EventPartition} — события, загруженные сейчас
+loaded_events = {}
+event_load_lock = asyncio.Lock()
+
+def event_dir(slug: str) -> str:
+    return os.path.join(EVENTS_DIR, slug)
+
+def event_exists(slug: str) -> bool:
+    return slug != EVENT_MAIN and os.path.isfile(os.path.join(event_dir(slug), "event.json"))
+
+def load_event_members():
+    global event_members
+    path = os.path.join(EVENTS_DIR, "members.json")
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            event_members = {int(k): v for k, v in json.load(f).items()}
+
+def save_event_members():
+    path = os.path.join(EVENTS_DIR, "members.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(event_members, f)
+    os.replace(path + ".tmp", path)
+
+def load_event_module(slug: str):
+    """
+    Свежий экземпляр этого модуля с настройками события: свои users, DATA_FILE,
+    ADMIN_IDS и вопросы. Хендлеры работают как есть, а данные разных событий
+    не пересекаются даже при параллельной обработке.
+    """
+    spec = importlib.util.spec_from_file_location(f"kts_event_{slug}", os.path.abspath(__file__))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    folder = event_dir(slug)
+    with open(os.path.join(folder, "event.json"), "r", encoding="utf-8") as f:
+        config = json.load(f)
+    module.EVENT_SLUG = slug
+    module.EVENTS_DIR = ""
+    module.DATA_FILE = os.path.join(folder, "party_data.json")
+    if config.get("admins"):
+        module.ADMIN_IDS = set(config["admins"])
+    for key, (attr, has_image) in QUESTION_BANKS.items():
+        if key not in config:
+            continue
+        questions = [tuple(q) for q in config[key]]
+        if has_image:
+            # картинки ищем сначала в каталоге события
+            questions = [
+                (os.path.join(folder, q[0]) if os.path.exists(os.path.join(folder, q[0])) else q[0],) + q[1:]
+                for q in questions
+            ]
+        setattr(module, attr, questions)
+    return module
+
+class EventPartition:
+    """
+    Загруженное событие: экземпляр модуля и его Application. Апдейты приходят
+    через EventRouter основного бота, отвечает событие через тот же бот.
+    """
+
+    def __init__(self, slug: str):
+        self.slug = slug
+        self.module = load_event_module(slug)
+        self.app = None
+        self.busy = 0
+        self.last_used = time.monotonic()
+
+    async def start(self):
+        module = self.module
+        module.load_data()
+        self.app = module.build_application(TOKEN, persistence=module.StorePersistence())
+        module.schedule_jobs(self.app, scoreboard=False)
+        await self.app.initialize()
+        await self.app.start()
+
+    async def stop(self):
+        await self.app.stop()
+        # shutdown сбрасывает persistence, после него — финальная запись
+        await self.app.shutdown()
+        self.module.save_data()
+        self.module.close_audit()
+
+async def get_event(slug: str):
+    partition = loaded_events.get(slug)
+    if partition is None:
+        async with event_load_lock:
+            partition = loaded_events.get(slug)
+            if partition is None:
+                if not event_exists(slug):
+                    return None
+                partition = EventPartition(slug)
+                await partition.start()
+                loaded_events[slug] = partition
+                print(f"Событие {slug} загружено, игроков: {len(partition.module.users)}")
+    partition.last_used = time.monotonic()
+    return partition
+
+async def unload_idle_events(context: ContextTypes.DEFAULT_TYPE):
+    cutoff = time.monotonic() - EVENT_IDLE_TTL
+    for slug, partition in list(loaded_events.items()):
+        if partition.busy == 0 and partition.last_used < cutoff:
+            del loaded_events[slug]
+            await partition.stop()
+            print(f"Событие {slug} выгружено после простоя")
+
+async def unload_all_events():
+    while loaded_events:
+        _, partition = loaded_events.popitem()
+        await partition.stop()
+
+def event_target(update: Update):
+    """
+    Событие для апдейта: по ссылке ev-<имя> или по прошлому выбору гостя.
+    None — основное событие, EVENT_MAIN — возврат в него по ссылке.
+    """
+    user = update.effective_user
+    if user is None:
+        return None
+    msg = update.effective_message
+    if msg is not None and msg.text:
+        m = EVENT_LINK_RE.match(msg.text.strip())
+        if m and (m.group(1) == EVENT_MAIN or event_exists(m.group(1))):
+            return m.group(1)
+    return event_members.get(user.id)
+
+async def route_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    slug = event_target(update)
+    tg_id = update.effective_user.id
+    if event_members.get(tg_id) != (None if slug == EVENT_MAIN else slug):
+        if slug == EVENT_MAIN:
+            event_members.pop(tg_id, None)
+        else:
+            event_members[tg_id] = slug
+        save_event_members()
+    if slug == EVENT_MAIN:
+        # /start ev-main дальше обработает основное событие
+        return
+
+    partition = await get_event(slug)
+    if partition is None:
+        # событие убрали из каталога — гость возвращается в основное
+        event_members.pop(tg_id, None)
+        save_event_members()
+        return
+    partition.busy += 1
+    try:
+        await partition.app.process_update(update)
+    finally:
+        partition.busy -= 1
+        partition.last_used = time.monotonic()
+    raise ApplicationHandlerStop
+
+class EventRouter(BaseHandler):
+    """
+    Срабатывает только на апдейты гостей других событий (и ссылки ev-...),
+    остальное идёт обычным хендлерам основного события.
+    """
+
+    def __init__(self):
+        super().__init__(route_event)
+
+    def check_update(self, update: object) -> bool:
+        return isinstance(update, Update) and event_target(update) is not None
+
+def list_events():
+    if not os.path.isdir(EVENTS_DIR):
+        return []
+    return sorted(name for name in os.listdir(EVENTS_DIR) if event_exists(name))
+
+def events_stats_text() -> str:
+    lines = [f"События: в каталоге {len(list_events())}, загружено {len(loaded_events)}"]
+    for slug, partition in sorted(loaded_events.items()):
+        idle = time.monotonic() - partition.last_used
+        lines.append(f"— {slug}: игроков {len(partition.module.users)}, простой {idle:.0f} с")
+    return "\n".join(lines)
+
+async def admin_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tg_id = update.effective_user.id
+    if tg_id not in ADMIN_IDS:
+        await update.message.reply_text("Эта функция доступна только организаторам.")
+        return
+
+    lines = ["Ссылки на события:", f"{EVENT_MAIN}: https://t.me/{context.bot.username}?start=ev-{EVENT_MAIN}"]
+    for slug in list_events():
+        mark = " (загружено)" if slug in loaded_events else ""
+        lines.append(f"{slug}{mark}: https://t.me/{context.bot.username}?start=ev-{slug}")
+    await update.message.reply_text("\n".join(lines), disable_web_page_preview=True)
+
+# =============================
+#            MAIN
+# =============================
+
+def build_application(token: str, request: BaseRequest = None, clock=time.monotonic,
+                      persistence: BasePersistence = None, label: str = None) -> Application:
+    """
+    label — метка дополнительного бота (EXTRA_BOT_TOKENS), у основного None.
+    """
+    builder = Application.builder().token(token)
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    if BOT_API_URL:
+        builder = builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+    if BOT_API_LOCAL_MODE:
+        builder = builder.local_mode(True)
+    if MAX_CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(PriorityUpdateProcessor(
+            MAX_CONCURRENT_UPDATES,
+            parse_class_map(SCHED_WEIGHTS),
+            parse_class_map(SCHED_LIMITS),
+        ))
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+        pools, send_pools = [], []
+    else:
+        bot_request, polling_request, pools = build_requests()
+        builder = builder.request(bot_request).get_updates_request(polling_request)
+        send_pools = [bot_request.regular, bot_request.media]
+    app = builder.build()
+    app.bot_data["http_pools"] = pools
+    app.bot_data["send_pools"] = send_pools
+    app.bot_data["bot_label"] = label
+
+    main_menu_handlers = [
+        # Выбор режима
+        MessageHandler(filters.Regex("^Я на вечеринке$"), choose_location),
+        MessageHandler(filters.Regex("^Я на удаленке$"), choose_location),
+
+        # Регистрация
+        MessageHandler(filters.Regex("^✍️ Регистрация$"), registration),
+
+        # Офлайн
+        MessageHandler(filters.Regex("^👁 Играть$"), play_offline),
+        MessageHandler(filters.Regex("^ℹ️ Правила игры$"), rules_offline),
+        MessageHandler(filters.Regex("^⚔️ Счёт команд$"), team_score),
+
+        # Онлайн общее
+        MessageHandler(filters.Regex("^Играть$"), online_play),
+        MessageHandler(filters.Regex("^Мои баллы$"), my_points),
+        MessageHandler(filters.Regex("^🧮 Мои баллы$"), my_points),
+        MessageHandler(filters.Regex("^Турнирная таблица$"), leaderboard),
+        MessageHandler(filters.Regex("^🏆 Турнирная таблица$"), leaderboard),
+
+        # Онлайн игры
+        MessageHandler(filters.Regex("^Где правда\\?$"), game_truth_start),
+        MessageHandler(filters.Regex("^Расшифруй код$"), game_binary_start),
+        MessageHandler(filters.Regex("^Правда или ложь$"), game_headline_start),
+        MessageHandler(filters.Regex("^Угадай мелодию$"), game_emoji_start),
+
+        # Админ
+        MessageHandler(filters.Regex("^➕ Добавить баллы$"), admin_add_start),
+        MessageHandler(filters.Regex("^Список участников$"), admin_list_participants),
+        MessageHandler(filters.Regex("^Топ-5 игроков в каждой команде$"), admin_top_teams),
+
+        # Назад
+        MessageHandler(filters.Regex("^🔙 В меню$"), back_to_menu),
+
+        # Назад
+        MessageHandler(filters.Regex("^🔙 В меню$"), back_to_menu),
+    ]
+
+    conv = ConversationHandler(
+        # после простоя диалог завершается — кнопки меню и любой текст снова его открывают
+        entry_points=[CommandHandler("start", start)] + main_menu_handlers + [
+            MessageHandler(filters.TEXT & ~filters.COMMAND, resume_session),
+        ],
+        states={
+            CHOOSING_LOCATION: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, choose_location),
             ],
+            MAIN_MENU: main_menu_handlers,
             REG_NAME: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, save_name),
             ],
@@ -1210,14 +4747,151 @@ def main():
             ADMIN_ADD_VALUE: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_get_value),
             ],
+            ConversationHandler.TIMEOUT: [
+                TypeHandler(Update, stash_session),
+            ],
         },
         fallbacks=[MessageHandler(filters.ALL & ~filters.COMMAND, fallback)],
+        conversation_timeout=SESSION_TTL or None,
+        name="main",
+        persistent=persistence is not None,
+    )
+    if conv.conversation_timeout:
+        check_conversation_internals(conv)
+
+    if store is not None:
+        # группа -5 — до всего остального: хендлеры видят изменения других воркеров
+        app.add_handler(TypeHandler(Update, sync_shared_state), group=-5)
+
+    # группа -4 — отмечаем активность пользователя для очистки простаивающих сессий
+    app.add_handler(TypeHandler(Update, touch_session), group=-4)
+
+    if EVENTS_DIR:
+        # группа -2, раньше фильтра нажатий: гости других событий уходят в их приложения,
+        # апдейты основного события EventRouter пропускает дальше
+        app.add_handler(EventRouter(), group=-2)
+
+    admission = AdmissionFilter(clock)
+    app.bot_data["admission"] = admission
+    # группа -2 — раньше всех хендлеров, отброшенный апдейт дальше не идёт
+    app.add_handler(TypeHandler(Update, admission.check), group=-2)
+
+    # группа -1 — раньше диалога: QR-ссылка срабатывает даже посреди игры
+    app.add_handler(CommandHandler("start", qr_start, has_args=1), group=-1)
+    # CSV со списком гостей — тоже до диалога, иначе его перехватит fallback
+    app.add_handler(
+        MessageHandler(filters.Document.FileExtension("csv"), admin_import_guests), group=-1
     )
 
     app.add_handler(conv)
+    app.add_handler(CommandHandler("qr_links", admin_qr_links))
+    app.add_handler(CommandHandler("live", live_board_toggle))
+    app.add_handler(InlineQueryHandler(inline_leaderboard))
+    app.add_handler(CommandHandler("profile", admin_profile))
+    app.add_handler(CommandHandler("stats", admin_stats))
+    app.add_handler(CommandHandler("audit", admin_audit))
+    app.add_handler(CommandHandler("undo", admin_undo))
+    app.add_handler(CommandHandler("qstats", admin_question_stats))
+    app.add_handler(CommandHandler("restore", admin_restore))
+    if EVENTS_DIR:
+        app.add_handler(CommandHandler("events", admin_events))
+    return app
+
+def parse_bot_tokens(raw: str):
+    # "floor1=123:AAA,floor2=456:BBB" -> [("floor1", "123:AAA"), ("floor2", "456:BBB")]
+    out = []
+    for part in raw.split(","):
+        label, _, token = part.strip().partition("=")
+        if not label and not token:
+            continue
+        label = label.strip()
+        if not token or label == "main" or "@" in label:
+            raise RuntimeError(f"Некорректный бот в EXTRA_BOT_TOKENS: «{part.strip()}»")
+        out.append((label, token.strip()))
+    return out
+
+async def run_bots(apps):
+    """
+    Несколько ботов в одном процессе и одном event loop: игроки, баллы и таблицы общие,
+    у каждого бота свои диалоги, пулы соединений и лимиты Telegram.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows — останавливаемся по KeyboardInterrupt
+            pass
+
+    running = []
+    try:
+        for app in apps:
+            await app.initialize()
+            await app.post_init(app)
+            await app.updater.start_polling()
+            await app.start()
+            running.append(app)
+        await stop.wait()
+    finally:
+        for app in reversed(running):
+            await app.updater.stop()
+            await app.stop()
+        for app in apps:
+            await app.shutdown()
+            await app.post_shutdown(app)
+
+async def post_init(app: Application):
+    if TRIAGE_BACKLOG:
+        await drain_backlog(app)
+
+async def post_shutdown(app: Application):
+    # события общие для всех ботов — выгружаем один раз
+    await unload_all_events()
 
-    print("Бот запущен...")
-    app.run_polling()
+def main():
+    # python kts_party_bot.py replay <лог.gz> [1|10|max] [эталон.json|-] [воркеров]
+    if len(sys.argv) > 2 and sys.argv[1] == "replay":
+        speed = sys.argv[3] if len(sys.argv) > 3 else "max"
+        expected = sys.argv[4] if len(sys.argv) > 4 and sys.argv[4] != "-" else None
+        workers = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+        ok = asyncio.run(replay_updates(sys.argv[2], speed, expected, workers))
+        sys.exit(0 if ok else 1)
+
+    extra_bots = parse_bot_tokens(EXTRA_BOT_TOKENS)
+    if WORKERS > 1:
+        if extra_bots or EVENTS_DIR:
+            raise RuntimeError("EXTRA_BOT_TOKENS и EVENTS_DIR пока не совместимы с WORKERS > 1.")
+        run_workers(WORKERS)
+        return
+
+    load_data()
+    if EVENTS_DIR:
+        load_event_members()
+    for label, token in [(None, TOKEN)] + extra_bots:
+        app = build_application(token, persistence=StorePersistence(label), label=label)
+        app.post_init = post_init
+        app.post_shutdown = post_shutdown
+        # табло одно на всех — его обслуживает основной бот
+        schedule_jobs(app, scoreboard=label is None, backups=label is None)
+        bot_apps[label or "main"] = app
+    if EVENTS_DIR:
+        bot_apps["main"].job_queue.run_repeating(unload_idle_events, interval=60, first=60)
+
+    if RECORD_FILE:
+        recorder = UpdateRecorder(RECORD_FILE)
+        for app in bot_apps.values():
+            # группа -3 — до фильтра нажатий, чтобы в записи был весь реальный трафик
+            app.add_handler(TypeHandler(Update, recorder.record), group=-3)
+
+    print(f"Бот запущен... ботов: {len(bot_apps)}")
+    try:
+        if len(bot_apps) == 1:
+            bot_apps["main"].run_polling()
+        else:
+            asyncio.run(run_bots(list(bot_apps.values())))
+    finally:
+        if RECORD_FILE:
+            recorder.close()
 
 if __name__ == "__main__":
     main()